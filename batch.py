@@ -0,0 +1,198 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import bigquery
+
+from main import Main, build_http_client, build_table_compactor, league_config
+from src.gbq import TableLoader
+from src.metrics import get_default_metrics, span
+from src.storage import storage_root
+from src.utils import get_logger, parse_args
+
+# The command line arguments of main.py that each league of the batch
+# sets in config.yaml instead
+LEAGUE_ARGS = (
+    "league_name",
+    "sleeper_season_id",
+    "espn_league_id",
+    "espn_s2",
+    "espn_swid",
+    # Not command line arguments: a league may set its own ESPN years,
+    # which default to those of the config
+    "espn_start_year",
+    "espn_end_year",
+)
+
+
+class Batch:
+    def __init__(self, config, argv=None, gbq_client=None, http_client=None):
+        """
+        Initialize the Batch class, which extracts every league listed
+            under leagues in the config concurrently, sharing one HTTP
+            client, response cache and BigQuery client, then loads each
+            BigQuery table once for all the leagues
+
+        :param config: The parsed config.yaml
+        :param argv: The command line arguments (those of main.py,
+            except the league's own). Defaults to sys.argv.
+        :param gbq_client: The client to load BigQuery tables with.
+            Defaults to a bigquery.Client.
+        :param http_client: The HttpClient to make every request with.
+            Defaults to a client built from the config.
+        """
+        self.config = config
+        self.leagues = self.config.get("leagues") or list()
+        self.league_workers = self.config.get("league_workers", 1)
+        self.args = parse_args(
+            [
+                item
+                for item in self.config["args"]
+                if _arg_name(item) not in LEAGUE_ARGS
+            ],
+            argv=argv,
+        )
+        self.metrics_path = self.args.get("metrics_path")
+        self.metrics = get_default_metrics()
+        self.logger = get_logger(
+            "Fantasy Football Stats", level=self.args["log_level"]
+        )
+        self.http_client = http_client or build_http_client(
+            self.config, cache_path=self.args.get("cache_path")
+        )
+        self.gbq_client = gbq_client or bigquery.Client()
+        self.table_loader = TableLoader(
+            self.gbq_client, self.logger, metrics=self.metrics
+        )
+        # Compacts the files of the loads combining every league, if
+        # enabled, under a directory named after the leagues
+        self.table_compactor = build_table_compactor(
+            self.config, storage_root(self.args["gcs_bucket"]), self.logger
+        )
+        self.compacted_name = "+".join(
+            sorted(str(league["league_name"]) for league in self.leagues)
+        )
+        self.mains = [
+            Main(
+                self.config,
+                args={
+                    **self.args,
+                    **dict.fromkeys(LEAGUE_ARGS),
+                    **{
+                        k: os.path.expandvars(v) if isinstance(v, str) else v
+                        for k, v in league.items()
+                    },
+                },
+                gbq_client=self.gbq_client,
+                http_client=self.http_client,
+            )
+            for league in self.leagues
+        ]
+
+    def __call__(self):
+        self.metrics.reset()
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.league_workers
+            ) as executor:
+                failures = list(executor.map(self._extract, self.mains))
+            with span("load_tables"):
+                load_summary = self.load_tables()
+        finally:
+            if self.metrics_path:
+                self.metrics.write(self.metrics_path)
+                self.logger.info(f"Wrote metrics to {self.metrics_path}")
+        failed_leagues = [failure for failure in failures if failure]
+        failed_tables = [
+            item["table_id"]
+            for item in load_summary
+            if item["status"] == "failed"
+        ]
+        if failed_leagues:
+            raise RuntimeError(
+                f"Failed to extract: {'; '.join(failed_leagues)}"
+            )
+        if failed_tables:
+            raise RuntimeError(
+                f"Failed to load tables: {', '.join(failed_tables)}"
+            )
+
+    def _extract(self, m):
+        """
+        Extract a league, logging rather than raising if it fails so
+            the other leagues are still extracted and loaded
+
+        :param m: The Main of the league
+        :return: A description of what failed, or None
+        """
+        try:
+            if m.watch and not m.should_run():
+                return None
+            failed_seasons = m.extract()
+        except Exception:
+            self.logger.exception(
+                f'Failed to extract league "{m.league_name}"'
+            )
+            return f"league {m.league_name}"
+        if failed_seasons:
+            return (
+                f"league {m.league_name} seasons {', '.join(failed_seasons)}"
+            )
+        return None
+
+    def load_tables(self):
+        """
+        Load every table from GCS to BigQuery once for all the leagues,
+            compacting the files of each load first if compaction is
+            enabled, as Main.load_tables does for a single league
+
+        :return: The load summary of TableLoader.load
+        """
+        loads = self.table_loads()
+        if self.table_compactor is not None:
+            with span("compact_tables"):
+                loads = self.table_compactor.compact(
+                    loads, self.compacted_name
+                )
+        return self.table_loader.load(loads)
+
+    def table_loads(self):
+        """
+        Combine the BigQuery loads of every league into one load per
+            table
+
+        :return: A list of dictionaries, as taken by TableLoader.load
+        """
+        loads = dict()
+        for m in self.mains:
+            for load in m.table_loads():
+                if load["table_id"] in loads:
+                    loads[load["table_id"]]["uris"].extend(load["uris"])
+                else:
+                    loads[load["table_id"]] = {
+                        **load,
+                        "uris": list(load["uris"]),
+                    }
+        return list(loads.values())
+
+
+def _arg_name(item):
+    """
+    Get the name argparse stores a command line arg under
+
+    :param item: A dictionary defining the arg, as taken by parse_args
+    :return: A string
+    """
+    definition = item["definition"]
+    if isinstance(definition, list):
+        definition = next(
+            (d for d in definition if d.startswith("--")), definition[0]
+        )
+    return definition.lstrip("-").replace("-", "_")
+
+
+if __name__ == "__main__":
+    b = Batch(league_config)
+    try:
+        b()
+    finally:
+        b.http_client.close()
@@ -0,0 +1,69 @@
+"""
+Wall-clock time and number of requests of building the ESPN seasons of
+a league against a local stub of the ESPN API: one espn_api League per
+year, one after another, against the views requested by ESPNSeason for
+every year at once.
+
+    python -m benchmarks.espn_seasons --years 6 --latency 0.1
+"""
+
+import argparse
+import time
+
+from espn_api.football import League
+from espn_api.requests import espn_requests
+
+from src.client import HttpClient
+from src.espn import ESPNSeason, fetch_seasons
+from benchmarks.stub_server import ESPNStub
+
+
+def run_league(years):
+    start = time.perf_counter()
+    for year in years:
+        League(league_id=1, year=year)
+    return time.perf_counter() - start
+
+
+def run_lean(base_url, years, concurrency):
+    client = HttpClient()
+    seasons = [
+        ESPNSeason(
+            1, "benchmark", None, None, year, base_url=base_url, client=client
+        )
+        for year in years
+    ]
+    start = time.perf_counter()
+    fetch_seasons(seasons, concurrency=concurrency)
+    for season in seasons:
+        season.get_season()
+    return time.perf_counter() - start
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--latency", type=float, default=0.05)
+    ap.add_argument("--years", type=int, default=6)
+    ap.add_argument("--pro-players", type=int, default=1000)
+    ap.add_argument("--concurrency", type=int, default=8)
+    args = ap.parse_args()
+    years = range(2018 - args.years, 2018)
+    with ESPNStub(
+        latency=args.latency, pro_players_count=args.pro_players
+    ) as stub:
+        # espn_api builds its URLs from this module constant
+        espn_requests.FANTASY_BASE_ENDPOINT = f"{stub.base_url}/"
+        print(f"{'fetcher':<22}  {'seconds':>8}  {'requests':>8}")
+        elapsed = run_league(years)
+        print(
+            f"{'League per year':<22}  {elapsed:>8.3f}  {stub.request_count:>8}"
+        )
+        stub.request_counts.clear()
+        elapsed = run_lean(f"{stub.base_url}/ffl", years, args.concurrency)
+        print(
+            f"{'ESPNSeason, at once':<22}  {elapsed:>8.3f}  {stub.request_count:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import fsspec
+import pyarrow.parquet as pq
+from google.api_core.exceptions import NotFound
+
+
+class FakeBigQueryClient:
+    def __init__(self, latency=0.0, file_latency=0.0):
+        """
+        A stand-in for bigquery.Client with the methods TableLoader
+            uses. A load job counts the rows of the parquet files it
+            would load, per partition for a partition decorator.
+
+        :param latency: The number of seconds each load job takes
+        :param file_latency: The number of seconds a load job takes per
+            file it reads
+        """
+        self.latency = latency
+        self.file_latency = file_latency
+        self.tables = dict()
+        self.load_count = 0
+        self.files_read = 0
+        self._lock = threading.Lock()
+
+    def load_table_from_uri(self, source_uris, table_id, job_config=None):
+        with self._lock:
+            self.load_count += 1
+        if isinstance(source_uris, str):
+            source_uris = [source_uris]
+        return FakeLoadJob(self, source_uris, table_id)
+
+    def get_table(self, table_id):
+        with self._lock:
+            if table_id not in self.tables:
+                raise NotFound(f"Not found: Table {table_id}")
+            table = self.tables[table_id]
+            return SimpleNamespace(
+                table_id=table_id,
+                labels=dict(table.labels),
+                range_partitioning=table.range_partitioning,
+                clustering_fields=table.clustering_fields,
+                num_rows=sum(table.partition_rows.values()),
+            )
+
+    def create_table(self, table, exists_ok=False):
+        table_id = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        with self._lock:
+            if table_id in self.tables and exists_ok:
+                return table
+            self.tables[table_id] = _stored_table(
+                table_id,
+                range_partitioning=table.range_partitioning,
+                clustering_fields=table.clustering_fields,
+            )
+        return table
+
+    def delete_table(self, table_id, not_found_ok=False):
+        with self._lock:
+            if self.tables.pop(table_id, None) is None and not not_found_ok:
+                raise NotFound(f"Not found: Table {table_id}")
+
+    def update_table(self, table, fields):
+        with self._lock:
+            stored_table = self.tables[table.table_id]
+            for field in fields:
+                setattr(stored_table, field, getattr(table, field))
+        return table
+
+
+class FakeLoadJob:
+    def __init__(self, client, source_uris, table_id):
+        self.client = client
+        self.source_uris = source_uris
+        self.table_id = table_id
+        self.output_rows = None
+
+    def result(self):
+        time.sleep(self.client.latency)
+        rows = 0
+        files = 0
+        for uri in self.source_uris:
+            prefix, suffix = uri.split("*", 1)
+            fs, fs_prefix = fsspec.core.url_to_fs(prefix)
+            for file_path in fs.find(fs_prefix):
+                if file_path.endswith(suffix):
+                    time.sleep(self.client.file_latency)
+                    with fs.open(file_path, "rb") as f:
+                        rows += pq.read_metadata(f).num_rows
+                    files += 1
+        self.output_rows = rows
+        table_id, _, partition = self.table_id.partition("$")
+        with self.client._lock:
+            self.client.files_read += files
+            if partition:
+                self.client.tables[table_id].partition_rows[partition] = rows
+            else:
+                self.client.tables[table_id] = _stored_table(table_id)
+                self.client.tables[table_id].partition_rows[None] = rows
+        return self
+
+
+def _stored_table(table_id, range_partitioning=None, clustering_fields=None):
+    return SimpleNamespace(
+        table_id=table_id,
+        labels=dict(),
+        range_partitioning=range_partitioning,
+        clustering_fields=clustering_fields,
+        partition_rows=dict(),
+    )
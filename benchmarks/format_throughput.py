@@ -0,0 +1,218 @@
+"""
+Records/sec of formatting API responses with a key_map, record by
+record (format_response) versus with a compiled extraction plan
+(format_columns), on synthetic player-level matchups.
+
+    python -m benchmarks.format_throughput --records 500000
+
+format_response is the reference for format_columns's semantics, which
+--equivalence checks on random key_maps and records instead, e.g. after
+changing the extraction plan or the handling of nested values:
+
+    python -m benchmarks.format_throughput --equivalence 20000
+"""
+
+import argparse
+import random
+import time
+
+import pandas as pd
+
+from src.utils import compile_key_map, format_columns, format_response
+
+POSITIONS = ["QB", "RB", "WR", "TE", "K", "DEF"]
+
+# The keys of the random key_maps and records. Few of them, so that
+# column names collide with each other and with nested keys.
+RANDOM_KEYS = "abcf"
+
+KEY_MAP = {
+    "season_id": {"data_type": "STRING"},
+    "week": {"data_type": "INT64"},
+    "matchup_id": {"data_type": "INT64"},
+    "roster_id": {"data_type": "INT64"},
+    "player_id": {"data_type": "STRING"},
+    "points": {"data_type": "FLOAT64"},
+    "is_starter": {"data_type": "BOOL"},
+    "metadata": {
+        "first_name": {"data_type": "STRING"},
+        "last_name": {"data_type": "STRING"},
+        "position": {"data_type": "STRING"},
+        "team": {"data_type": "STRING"},
+        "injury": {"status": {"data_type": "STRING"}},
+    },
+}
+
+
+def synthetic_player_matchups(records_count, seed=0):
+    """
+    Generate records shaped like a full history of player-level Sleeper
+        matchups: 12 rosters of 16 players for 17 weeks per season
+
+    :param records_count: The number of records to generate
+    :param seed: The seed of the random number generator
+    :return: A list of (nested) dictionaries
+    """
+    rng = random.Random(seed)
+    records = list()
+    for i in range(records_count):
+        season, rest = divmod(i, 17 * 12 * 16)
+        week, rest = divmod(rest, 12 * 16)
+        roster_id, slot = divmod(rest, 16)
+        records.append(
+            {
+                "season_id": str(1000 + season),
+                "week": week + 1,
+                "matchup_id": roster_id // 2 + 1,
+                "roster_id": roster_id + 1,
+                "player_id": str(rng.randrange(10000)),
+                "points": round(rng.uniform(0, 40), 2),
+                "is_starter": slot < 9,
+                "metadata": {
+                    "first_name": "First",
+                    "last_name": "Last",
+                    "position": rng.choice(POSITIONS),
+                    "team": "NYG",
+                    "injury": {"status": None} if slot % 5 else None,
+                },
+                "players_points": {"ignored": 1.0},
+            }
+        )
+    return records
+
+
+def random_key_map(rng, depth=0):
+    """
+    Generate a random key_map up to three levels deep, whose leaves
+        may be renamed to any key
+
+    :param rng: A random.Random
+    :param depth: The depth of the key_map (used when recursing)
+    :return: A (potentially nested) key_map
+    """
+    key_map = dict()
+    for key in rng.sample(RANDOM_KEYS, rng.randint(1, 3)):
+        if depth < 2 and rng.random() < 0.4:
+            key_map[key] = random_key_map(rng, depth + 1)
+            continue
+        key_map[key] = {"data_type": "STRING"}
+        if rng.random() < 0.3:
+            key_map[key]["col_name"] = rng.choice(RANDOM_KEYS)
+    return key_map
+
+
+def random_value(rng, depth=1):
+    """
+    Generate a random value of a record: a scalar, None or a
+        dictionary of random values
+
+    :param rng: A random.Random
+    :param depth: The depth of the value within the record
+    :return: A value
+    """
+    if depth < 3 and rng.random() < 0.4:
+        return {
+            key: random_value(rng, depth + 1)
+            for key in rng.sample(RANDOM_KEYS, rng.randint(0, 3))
+        }
+    return rng.choice([None, 1, 2, "x"])
+
+
+def check_equivalence(cases_count, seed=0):
+    """
+    Check that format_columns formats random records with random
+        key_maps like format_response, the last value written under a
+        column name winning and the columns missing from a record being
+        None
+
+    :param cases_count: The number of random key_maps to check
+    :param seed: The seed of the random number generator
+    :return: The number of cases checked. format_response cannot walk
+        a leaf of the key_map into a dictionary, so the cases where it
+        raises are skipped.
+    :raises AssertionError: At the first case formatted differently
+    """
+    rng = random.Random(seed)
+    checked = 0
+    for _ in range(cases_count):
+        key_map = random_key_map(rng)
+        records = [
+            {
+                key: random_value(rng)
+                for key in rng.sample(RANDOM_KEYS, rng.randint(0, 4))
+            }
+            for _ in range(rng.randint(1, 4))
+        ]
+        try:
+            expected_records = format_response(records, key_map)
+        except AttributeError:
+            continue
+        col_names = list()
+        for record in expected_records:
+            col_names.extend(k for k in record if k not in col_names)
+        expected = {
+            col_name: [record.get(col_name) for record in expected_records]
+            for col_name in col_names
+        }
+        actual = format_columns(records, key_map)
+        assert actual == expected, (
+            f"key_map {key_map}, records {records}: format_response "
+            f"gives {expected}, format_columns gives {actual}"
+        )
+        checked += 1
+    return checked
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--records", type=int, default=500000)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument(
+        "--equivalence",
+        type=int,
+        metavar="CASES",
+        help="Check format_columns against format_response on this many "
+        "random key_maps instead of timing them",
+    )
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    if args.equivalence:
+        checked = check_equivalence(args.equivalence, seed=args.seed)
+        print(f"format_columns matched format_response in {checked} cases")
+        return
+    records = synthetic_player_matchups(args.records)
+
+    def records_path():
+        return pd.DataFrame(format_response(records, KEY_MAP))
+
+    plan = compile_key_map(KEY_MAP)
+
+    def columns_path():
+        return pd.DataFrame(format_columns(records, plan))
+
+    results = dict()
+    for name, path in [
+        ("format_response", records_path),
+        ("format_columns", columns_path),
+    ]:
+        timings = list()
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results[name] = path()
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        print(
+            f"{name:<16} {best:>7.3f} s  {args.records / best:>12,.0f} records/sec"
+        )
+    # A nested value that is not a dictionary (injury) is kept as its
+    # own column by both, but not necessarily in the same position, and
+    # a column that is all null may be inferred as float or object
+    by_records, by_columns = [
+        df.astype(object).where(df.notna(), None)
+        for df in (results["format_response"], results["format_columns"])
+    ]
+    pd.testing.assert_frame_equal(by_records, by_columns, check_like=True)
+
+
+if __name__ == "__main__":
+    main()
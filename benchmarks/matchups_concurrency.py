@@ -0,0 +1,57 @@
+"""
+Wall-clock time of SleeperSeason.get_matchups against a local stub of
+the Sleeper API as the request concurrency goes up.
+
+    python -m benchmarks.matchups_concurrency --latency 0.1
+"""
+
+import argparse
+import time
+
+from src.sleeper import SleeperSeason
+from src.utils import parse_yaml
+from benchmarks.stub_server import SleeperStub
+
+
+def run(base_url, concurrency, key_map):
+    season = SleeperSeason("1", "benchmark", base_url=base_url)
+    season.concurrency = concurrency
+    season.start_week = 1
+    season.playoff_start_week = 15
+    season.playoff_rounds_count = 3
+    start = time.perf_counter()
+    matchups = season.get_matchups(key_map=key_map)
+    return time.perf_counter() - start, matchups
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--latency", type=float, default=0.05)
+    ap.add_argument("--rosters", type=int, default=12)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 17]
+    )
+    args = ap.parse_args()
+    key_map = parse_yaml("config.yaml")["tables"]["sleeper"]["matchups"][
+        "key_map"
+    ]
+    with SleeperStub(rosters_count=args.rosters, latency=args.latency) as stub:
+        _, baseline = run(stub.base_url, 1, key_map)
+        print(f"{'concurrency':>11}  {'best (s)':>9}  {'speedup':>7}")
+        sequential = None
+        for concurrency in args.concurrency:
+            timings = list()
+            for _ in range(args.repeat):
+                elapsed, matchups = run(stub.base_url, concurrency, key_map)
+                assert matchups.equals(baseline), "week order changed"
+                timings.append(elapsed)
+            best = min(timings)
+            sequential = sequential or best
+            print(
+                f"{concurrency:>11}  {best:>9.3f}  {sequential / best:>6.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
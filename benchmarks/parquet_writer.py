@@ -0,0 +1,161 @@
+"""
+Import time, write time and peak memory of writing a formatted table to
+parquet through pandas and dask (the previous load_season path) versus
+converting it to Arrow and writing it with pyarrow (src.storage). Both
+start from the same DataFrame, which the pipeline still builds to hash
+and partition each table. Each path runs in its own process
+on the same pickled DataFrame so that their imports and peak RSS are
+measured separately. The dask path needs dask installed, which the
+pipeline no longer requires.
+
+    python -m benchmarks.parquet_writer --records 500000
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def dask_path(df, schema, path):
+    """
+    Write df the way load_season did before the Arrow writer
+    """
+    import numpy as np
+    import dask.dataframe as dd
+
+    df = df.replace("", np.nan)
+    ddf = dd.from_pandas(df, npartitions=1)
+    dd.to_parquet(
+        ddf, path, engine="pyarrow", schema=schema, write_index=False
+    )
+
+
+def arrow_path(df, schema, path):
+    """
+    Write df the way load_season does with the Arrow writer
+    """
+    from src.storage import to_arrow_table, write_parquet
+
+    write_parquet(to_arrow_table(df, schema), path)
+
+
+def generate(records_count, frame_path):
+    """
+    Format synthetic records and pickle them as a DataFrame
+    """
+    import pandas as pd
+
+    from benchmarks.format_throughput import (
+        KEY_MAP,
+        synthetic_player_matchups,
+    )
+    from src.utils import compile_key_map, format_columns
+
+    records = synthetic_player_matchups(records_count)
+    df = pd.DataFrame(format_columns(records, compile_key_map(KEY_MAP)))
+    df.to_pickle(frame_path)
+
+
+def run(path_name, frame_path):
+    """
+    Run one path in this process on a pickled DataFrame and print its
+    timings as JSON
+    """
+    start = time.perf_counter()
+    if path_name == "dask":
+        import dask.dataframe  # noqa: F401
+    else:
+        import src.storage  # noqa: F401
+    import_seconds = time.perf_counter() - start
+
+    import pandas as pd
+    import pyarrow as pa
+
+    from benchmarks.format_throughput import KEY_MAP
+    from src.utils import get_data_types
+
+    df = pd.read_pickle(frame_path)
+    data_types = get_data_types(KEY_MAP)
+    if path_name == "dask":
+        types = {"STRING": pa.string(), "INT64": pa.int64()}
+        types.update({"FLOAT64": pa.float64(), "BOOL": pa.bool_()})
+        schema = {
+            col: types[data_type] for col, data_type in data_types.items()
+        }
+        write = dask_path
+    else:
+        schema = data_types
+        write = arrow_path
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        write(df, schema, f"{directory}/table")
+        write_seconds = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        json.dumps(
+            {
+                "import_seconds": import_seconds,
+                "write_seconds": write_seconds,
+                # ru_maxrss is in KiB on Linux
+                "write_peak_mib": (peak_rss - baseline_rss) / 1024,
+                "peak_mib": peak_rss / 1024,
+            }
+        )
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--records", type=int, default=500000)
+    ap.add_argument("--run", choices=["generate", "dask", "arrow"])
+    ap.add_argument("--frame-path")
+    args = ap.parse_args()
+    if args.run == "generate":
+        generate(args.records, args.frame_path)
+        return
+    if args.run:
+        run(args.run, args.frame_path)
+        return
+    # Every step runs in a fresh process, as Linux carries the peak RSS
+    # of a process over to the processes it forks
+    directory = tempfile.TemporaryDirectory()
+    frame_path = f"{directory.name}/frame.pkl"
+    for path_name in ("generate", "dask", "arrow"):
+        completed = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.parquet_writer",
+                "--records",
+                str(args.records),
+                "--run",
+                path_name,
+                "--frame-path",
+                frame_path,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if path_name == "generate":
+            completed.check_returncode()
+            continue
+        if completed.returncode:
+            print(f"{path_name:<6} failed:\n{completed.stderr}")
+            continue
+        result = json.loads(completed.stdout.splitlines()[-1])
+        print(
+            f"{path_name:<6} import {result['import_seconds']:>6.2f} s  "
+            f"write {result['write_seconds']:>6.2f} s  "
+            f"write peak +{result['write_peak_mib']:>7.1f} MiB  "
+            f"peak {result['peak_mib']:>7.1f} MiB"
+        )
+    directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
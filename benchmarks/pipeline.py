@@ -0,0 +1,328 @@
+"""
+End-to-end run of Main against local stubs of the Sleeper and ESPN
+APIs, with the tables stored in a local directory instead of GCS and
+loaded by a fake BigQuery client. Reports the latency of each stage,
+HTTP calls, rows/sec and peak RSS.
+
+    python -m benchmarks.pipeline --seasons 5 --espn-seasons 3 --runs 2
+
+The ESPN seasons precede the oldest Sleeper season, so with the default
+first Sleeper season of 2020 they include seasons before 2018, served
+from the league's history.
+
+Every run starts from empty storage. Pass --cache-path to keep API
+responses between runs (and between invocations), --write-latency to
+add the round trips of writing to GCS to every parquet write, and
+--load-file-latency to make the BigQuery load jobs take longer the more
+files they read. --no-compaction loads the extracted files as they are.
+
+--batch runs batch.py instead, on two leagues sharing the stubs: the
+league above, and a Sleeper-only league (without an ESPN league ID)
+whose chain starts a season earlier.
+"""
+
+import argparse
+import copy
+import functools
+import json
+import resource
+import tempfile
+import time
+
+import main as pipeline
+from batch import Batch
+from benchmarks.fake_bigquery import FakeBigQueryClient
+from benchmarks.stub_server import ESPNStub, SleeperStub
+from main import Main, league_config
+from src.espn import ESPNSeason
+
+STAGES = ("discover_seasons", "load_seasons", "load_tables")
+ESPN_LEAGUE_ID = "1"
+
+
+def bench_config(
+    base_url,
+    cache_path=None,
+    rate_limit=False,
+    espn_base_url=None,
+    espn_end_year=0,
+    espn_seasons=0,
+):
+    """
+    Adapt config.yaml to the stubs: the ESPN seasons asked for, and no
+        response cache or rate limit unless asked for
+
+    :param base_url: The base URL of the Sleeper stub
+    :param cache_path: The directory to cache API responses in
+    :param rate_limit: Whether to keep the configured rate limits
+    :param espn_base_url: The base URL of the ESPN stub's API
+    :param espn_end_year: The year of the last ESPN season, the year
+        before the oldest Sleeper season
+    :param espn_seasons: The number of ESPN seasons. 0 extracts none.
+    :return: A config dictionary
+    """
+    config = copy.deepcopy(league_config)
+    config["sleeper_base_url"] = base_url
+    if espn_seasons:
+        config["espn_base_url"] = espn_base_url
+        config["espn_start_year"] = espn_end_year - espn_seasons + 1
+        config["espn_end_year"] = espn_end_year
+    else:
+        config["espn_start_year"] = 0
+        config["espn_end_year"] = 0
+    config["cache"] = {**config.get("cache", dict()), "path": cache_path}
+    if not rate_limit:
+        config.get("http", dict()).pop("rate_limits", None)
+    return config
+
+
+def _timed(method, stage, timings):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timings[stage] = time.perf_counter() - start
+
+    return wrapper
+
+
+def _slowed(write_parquet, latency):
+    @functools.wraps(write_parquet)
+    def wrapper(*args, **kwargs):
+        time.sleep(latency)
+        return write_parquet(*args, **kwargs)
+
+    return wrapper
+
+
+def run(
+    stub,
+    config,
+    storage_dir,
+    log_level="WARNING",
+    load_file_latency=0.0,
+    espn_stub=None,
+):
+    """
+    Run the whole pipeline once
+
+    :param stub: A running SleeperStub
+    :param config: The config returned by bench_config
+    :param storage_dir: The directory to store the tables in
+    :param log_level: The log level of the pipeline
+    :param load_file_latency: The number of seconds a BigQuery load
+        job takes per file it reads
+    :param espn_stub: The running ESPNStub the ESPN seasons are
+        requested from, if config has any
+    :return: A dictionary of measurements
+    """
+    stubs = [stub] if espn_stub is None else [stub, espn_stub]
+    # Every run looks the drafted ESPN players up again
+    ESPNSeason.players.clear()
+    gbq_client = FakeBigQueryClient(file_latency=load_file_latency)
+    m = Main(
+        config,
+        argv=[
+            "benchmark",
+            stub.current_season_id,
+            storage_dir,
+            "benchmark-project",
+            "benchmark_dataset",
+            "--espn-league-id",
+            ESPN_LEAGUE_ID,
+            "--log-level",
+            log_level,
+        ],
+        gbq_client=gbq_client,
+    )
+    timings = dict()
+    for stage in STAGES:
+        setattr(m, stage, _timed(getattr(m, stage), stage, timings))
+    requests_before = sum(s.request_count for s in stubs)
+    start = time.perf_counter()
+    try:
+        m()
+    finally:
+        m.http_client.close()
+    total_seconds = time.perf_counter() - start
+    rows = sum(
+        table["rows"]
+        for season in m.manifest.seasons.values()
+        for table in season["tables"].values()
+    )
+    return {
+        "seconds": total_seconds,
+        "stages": timings,
+        "seasons": len(m.manifest.seasons),
+        "rows": rows,
+        "rows_per_second": rows / timings["load_seasons"],
+        "http_requests": sum(s.request_count for s in stubs) - requests_before,
+        "bigquery_loads": gbq_client.load_count,
+        "bigquery_files_read": gbq_client.files_read,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / 1024,
+    }
+
+
+def run_batch(
+    stub,
+    config,
+    storage_dir,
+    log_level="WARNING",
+    load_file_latency=0.0,
+    espn_stub=None,
+):
+    """
+    Run batch.py once on two leagues: the league run extracts, and a
+        Sleeper-only league whose current season is the previous season
+        of the first league
+
+    :param stub: A running SleeperStub
+    :param config: The config returned by bench_config
+    :param storage_dir: The directory to store the tables in
+    :param log_level: The log level of the pipeline
+    :param load_file_latency: The number of seconds a BigQuery load
+        job takes per file it reads
+    :param espn_stub: The running ESPNStub the ESPN seasons of the
+        first league are requested from, if config has any
+    :return: A dictionary of measurements, as returned by run
+    """
+    stubs = [stub] if espn_stub is None else [stub, espn_stub]
+    ESPNSeason.players.clear()
+    gbq_client = FakeBigQueryClient(file_latency=load_file_latency)
+    config = {
+        **config,
+        "leagues": [
+            {
+                "league_name": "benchmark",
+                "sleeper_season_id": stub.current_season_id,
+                "espn_league_id": ESPN_LEAGUE_ID,
+            },
+            {
+                "league_name": "benchmark_sleeper_only",
+                "sleeper_season_id": str(int(stub.current_season_id) - 1),
+            },
+        ],
+    }
+    b = Batch(
+        config,
+        argv=[
+            storage_dir,
+            "benchmark-project",
+            "benchmark_dataset",
+            "--log-level",
+            log_level,
+        ],
+        gbq_client=gbq_client,
+    )
+    timings = dict()
+    b.load_tables = _timed(b.load_tables, "load_tables", timings)
+    requests_before = sum(s.request_count for s in stubs)
+    start = time.perf_counter()
+    try:
+        b()
+    finally:
+        b.http_client.close()
+    total_seconds = time.perf_counter() - start
+    timings = {
+        "extract": total_seconds - timings["load_tables"],
+        "load_tables": timings["load_tables"],
+    }
+    rows = sum(
+        table["rows"]
+        for m in b.mains
+        for season in m.manifest.seasons.values()
+        for table in season["tables"].values()
+    )
+    return {
+        "seconds": total_seconds,
+        "stages": timings,
+        "seasons": sum(len(m.manifest.seasons) for m in b.mains),
+        "rows": rows,
+        "rows_per_second": rows / timings["extract"],
+        "http_requests": sum(s.request_count for s in stubs) - requests_before,
+        "bigquery_loads": gbq_client.load_count,
+        "bigquery_files_read": gbq_client.files_read,
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / 1024,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seasons", type=int, default=5)
+    ap.add_argument("--espn-seasons", type=int, default=3)
+    ap.add_argument("--first-year", type=int, default=2020)
+    ap.add_argument("--rosters", type=int, default=12)
+    ap.add_argument("--players", type=int, default=15)
+    ap.add_argument("--latency", type=float, default=0.02)
+    ap.add_argument("--write-latency", type=float, default=0.0)
+    ap.add_argument("--load-file-latency", type=float, default=0.0)
+    ap.add_argument("--no-compaction", action="store_true")
+    ap.add_argument("--batch", action="store_true")
+    ap.add_argument("--runs", type=int, default=1)
+    ap.add_argument("--cache-path")
+    ap.add_argument("--rate-limit", action="store_true")
+    ap.add_argument("--log-level", default="WARNING")
+    ap.add_argument("--json", help="Write the measurements to this file")
+    args = ap.parse_args()
+    if args.write_latency:
+        pipeline.write_parquet = _slowed(
+            pipeline.write_parquet, args.write_latency
+        )
+    results = list()
+    with SleeperStub(
+        rosters_count=args.rosters,
+        latency=args.latency,
+        seasons_count=args.seasons,
+        players_count=args.players,
+        first_year=args.first_year,
+    ) as stub, ESPNStub(
+        teams_count=args.rosters,
+        latency=args.latency,
+        players_count=args.players,
+    ) as espn_stub:
+        config = bench_config(
+            stub.base_url,
+            cache_path=args.cache_path,
+            rate_limit=args.rate_limit,
+            espn_base_url=f"{espn_stub.base_url}/ffl",
+            espn_end_year=args.first_year - 1,
+            espn_seasons=args.espn_seasons,
+        )
+        if args.no_compaction:
+            config["compaction"] = {"enabled": False}
+        for i in range(args.runs):
+            with tempfile.TemporaryDirectory() as storage_dir:
+                result = (run_batch if args.batch else run)(
+                    stub,
+                    config,
+                    storage_dir,
+                    args.log_level,
+                    load_file_latency=args.load_file_latency,
+                    espn_stub=espn_stub,
+                )
+            results.append(result)
+            stages = "  ".join(
+                f"{stage} {seconds:.2f}s"
+                for stage, seconds in result["stages"].items()
+            )
+            print(
+                f"run {i + 1}: {result['seconds']:.2f}s ({stages})  "
+                f"{result['seasons']} seasons  {result['rows']} rows  "
+                f"{result['rows_per_second']:,.0f} rows/sec  "
+                f"{result['http_requests']} HTTP requests  "
+                f"{result['bigquery_loads']} BigQuery loads reading "
+                f"{result['bigquery_files_read']} files  "
+                f"peak RSS {result['peak_rss_mib']:.0f} MiB"
+            )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,542 @@
+import collections
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+POSITIONS = ["QB", "RB", "WR", "TE", "K", "DEF"]
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _Stub:
+    def __init__(self, latency):
+        """
+        A local HTTP server answering the GET requests matching its
+            routes, a list of tuples of a compiled regular expression
+            (matched against the path and query string) and a function
+            taking its groups and returning the JSON body. A route can
+            read the headers of the request from self._request.headers.
+
+        :param latency: The number of seconds to wait before answering
+            each request, to stand in for the network round trip
+        """
+        self.latency = latency
+        self.request_counts = collections.Counter()
+        self.connections_count = 0
+        self._lock = threading.Lock()
+        self._routes = list()
+        # The headers of the request being answered by the thread
+        self._request = threading.local()
+        self._server = _Server(("127.0.0.1", 0), self._handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def request_count(self):
+        return sum(self.request_counts.values())
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep the connections alive between requests, as the APIs do
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections_count += 1
+
+            def do_GET(self):
+                time.sleep(stub.latency)
+                for pattern, route in stub._routes:
+                    match = pattern.match(self.path)
+                    if match:
+                        stub._request.headers = self.headers
+                        with stub._lock:
+                            stub.request_counts[route.__name__] += 1
+                        body = json.dumps(route(*match.groups())).encode()
+                        self.send_response(200)
+                        self.send_header("Content-Type", "application/json")
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+                        return
+                with stub._lock:
+                    stub.request_counts["not_found"] += 1
+                self.send_error(404)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class SleeperStub(_Stub):
+    def __init__(
+        self,
+        rosters_count=12,
+        latency=0.05,
+        seasons_count=1,
+        players_count=15,
+        first_year=2020,
+        current_week=None,
+    ):
+        """
+        A local HTTP server serving synthetic Sleeper API responses for
+            a chain of completed seasons, with the season IDs 1000,
+            1001, ... from the oldest season to the current one
+
+        :param rosters_count: The number of rosters in each league
+        :param latency: The number of seconds to wait before answering
+            each request, to stand in for the network round trip
+        :param seasons_count: The number of seasons in the chain
+        :param players_count: The number of players on each roster
+        :param first_year: The year of the oldest season
+        :param current_week: The NFL week in progress, to serve the
+            current season as in progress with the weeks before it
+            scored. Defaults to serving every season as complete. Can
+            be changed while the server runs.
+        """
+        super().__init__(latency)
+        self.rosters_count = rosters_count
+        self.seasons_count = seasons_count
+        self.players_count = players_count
+        self.first_year = first_year
+        self.current_week = current_week
+        self._routes = [
+            (re.compile(r"^/league/(\w+)$"), self.season),
+            (re.compile(r"^/league/(\w+)/rosters$"), self.rosters),
+            (re.compile(r"^/league/(\w+)/users$"), self.users),
+            (
+                re.compile(r"^/league/(\w+)/winners_bracket$"),
+                self.winners_bracket,
+            ),
+            (re.compile(r"^/league/(\w+)/matchups/(\d+)$"), self.matchups),
+            (
+                re.compile(r"^/league/(\w+)/transactions/(\d+)$"),
+                self.transactions,
+            ),
+            (re.compile(r"^/draft/(\w+)/picks$"), self.draft_picks),
+            (re.compile(r"^/state/nfl$"), self.state),
+        ]
+
+    @property
+    def current_season_id(self):
+        return str(1000 + self.seasons_count - 1)
+
+    def season(self, season_id):
+        index = int(season_id) - 1000
+        if not 0 <= index < self.seasons_count:
+            return None
+        in_progress = (
+            self.current_week is not None and index == self.seasons_count - 1
+        )
+        return {
+            "league_id": season_id,
+            "name": "Benchmark League",
+            "season": str(self.first_year + index),
+            "status": "in_season" if in_progress else "complete",
+            "previous_league_id": str(int(season_id) - 1) if index else None,
+            "draft_id": f"9{season_id}",
+            "total_rosters": self.rosters_count,
+            "settings": {
+                "start_week": 1,
+                "playoff_week_start": 15,
+                "last_scored_leg": (
+                    self.current_week - 1 if in_progress else 17
+                ),
+                "league_average_match": 0,
+                "playoff_teams": 6,
+            },
+        }
+
+    def state(self):
+        year = self.first_year + self.seasons_count - 1
+        if self.current_week is None:
+            return {"season": str(year + 1), "season_type": "off", "week": 0}
+        return {
+            "season": str(year),
+            "season_type": "regular",
+            "week": self.current_week,
+        }
+
+    def rosters(self, season_id):
+        return [
+            {
+                "roster_id": roster_id,
+                "owner_id": f"{roster_id}00",
+                "players": self._players(roster_id),
+                "settings": {"wins": roster_id % 14, "losses": 14 - roster_id},
+            }
+            for roster_id in range(1, self.rosters_count + 1)
+        ]
+
+    def users(self, season_id):
+        return [
+            {
+                "user_id": f"{roster_id}00",
+                "display_name": f"Manager {roster_id}",
+                "metadata": {"team_name": f"Team {roster_id}"},
+            }
+            for roster_id in range(1, self.rosters_count + 1)
+        ]
+
+    def winners_bracket(self, season_id):
+        # 6 playoff teams: 2 first round byes, then the semifinals, then
+        # the final and the third place game
+        return [
+            {"r": 1, "m": 1, "t1": 3, "t2": 6, "w": 3, "l": 6},
+            {"r": 1, "m": 2, "t1": 4, "t2": 5, "w": 4, "l": 5},
+            {"r": 2, "m": 3, "t1": 1, "t2": 4, "w": 1, "l": 4},
+            {"r": 2, "m": 4, "t1": 2, "t2": 3, "w": 2, "l": 3},
+            {"r": 3, "m": 5, "t1": 1, "t2": 2, "w": 1, "l": 2, "p": 1},
+            {"r": 3, "m": 6, "t1": 4, "t2": 3, "w": 3, "l": 4, "p": 3},
+        ]
+
+    def matchups(self, season_id, week):
+        week = int(week)
+        return [
+            {
+                "roster_id": roster_id,
+                "matchup_id": (roster_id + 1) // 2,
+                "points": round(80 + (roster_id * 7 + week * 3) % 60, 2),
+                "custom_points": None,
+                "starters": self._players(roster_id)[:9],
+                "players": self._players(roster_id),
+                "players_points": {
+                    player_id: round((int(player_id) * week) % 30, 2)
+                    for player_id in self._players(roster_id)
+                },
+            }
+            for roster_id in range(1, self.rosters_count + 1)
+        ]
+
+    def transactions(self, season_id, week):
+        # A waiver claim and a free agent move per roster, and a trade
+        # of players and draft picks between two rosters
+        week = int(week)
+        transactions = list()
+        for roster_id in range(1, self.rosters_count + 1):
+            for i, transaction_type in enumerate(("waiver", "free_agent")):
+                player_id = str(9000 + week * 100 + roster_id * 2 + i)
+                transactions.append(
+                    {
+                        "transaction_id": f"{season_id}{week:02}{roster_id:02}{i}",
+                        "type": transaction_type,
+                        "status": "complete",
+                        "leg": week,
+                        "creator": f"{roster_id}00",
+                        "created": 1600000000000 + week * 604800000,
+                        "status_updated": 1600000000000 + week * 604800000,
+                        "roster_ids": [roster_id],
+                        "settings": (
+                            {"waiver_bid": roster_id}
+                            if transaction_type == "waiver"
+                            else None
+                        ),
+                        "adds": {player_id: roster_id},
+                        "drops": {
+                            self._players(roster_id)[
+                                week % self.players_count
+                            ]: roster_id
+                        },
+                        "draft_picks": [],
+                    }
+                )
+        transactions.append(
+            {
+                "transaction_id": f"{season_id}{week:02}990",
+                "type": "trade",
+                "status": "complete",
+                "leg": week,
+                "creator": "100",
+                "created": 1600000000000 + week * 604800000,
+                "status_updated": 1600000000000 + week * 604800000,
+                "roster_ids": [1, 2],
+                "settings": None,
+                "adds": {
+                    self._players(1)[0]: 2,
+                    self._players(2)[0]: 1,
+                },
+                "drops": {
+                    self._players(1)[0]: 1,
+                    self._players(2)[0]: 2,
+                },
+                "draft_picks": [
+                    {
+                        "season": str(self.first_year + 1),
+                        "round": round_num,
+                        "roster_id": roster_id,
+                        "previous_owner_id": roster_id,
+                        "owner_id": 3 - roster_id,
+                    }
+                    for roster_id in (1, 2)
+                    for round_num in (1, 2)
+                ],
+            }
+        )
+        return transactions
+
+    def draft_picks(self, draft_id):
+        picks = list()
+        for round_num in range(1, self.players_count + 1):
+            for draft_slot in range(1, self.rosters_count + 1):
+                player_id = self._players(draft_slot)[round_num - 1]
+                picks.append(
+                    {
+                        "draft_id": draft_id,
+                        "pick_no": len(picks) + 1,
+                        "round": round_num,
+                        "draft_slot": draft_slot,
+                        "player_id": player_id,
+                        "roster_id": draft_slot,
+                        "picked_by": f"{draft_slot}00",
+                        "is_keeper": None,
+                        "metadata": {
+                            "first_name": "First",
+                            "last_name": f"Last{player_id}",
+                            "position": POSITIONS[int(player_id) % 6],
+                            "team": "NYG",
+                            "years_exp": str(int(player_id) % 12),
+                            "status": "Active",
+                            "injury_status": "",
+                        },
+                    }
+                )
+        return picks
+
+    def _players(self, roster_id):
+        return [
+            str(roster_id * 100 + slot) for slot in range(self.players_count)
+        ]
+
+
+class ESPNStub(_Stub):
+    def __init__(
+        self,
+        teams_count=10,
+        latency=0.05,
+        players_count=15,
+        pro_players_count=1000,
+    ):
+        """
+        A local HTTP server serving synthetic ESPN fantasy football API
+            responses for any league and season, under the base URL
+            base_url + "/ffl". Every request for a league is answered
+            with all the views ESPN has for it, but the player cards
+            (kona_playercard), answered with the cards of the players
+            of the x-fantasy-filter header. The last round of each
+            draft picks a player dropped before the end of the season,
+            so only found by their player card.
+
+        :param teams_count: The number of teams in each league
+        :param latency: The number of seconds to wait before answering
+            each request, to stand in for the network round trip
+        :param players_count: The number of players on each roster
+        :param pro_players_count: The number of NFL players listed by
+            the players endpoint (players_wl), which espn_api's League
+            requests for every season
+        """
+        super().__init__(latency)
+        self.teams_count = teams_count
+        self.players_count = players_count
+        self.pro_players_count = pro_players_count
+        self._routes = [
+            (
+                re.compile(
+                    r"^/ffl/seasons/\d+/segments/0/leagues/\d+\?.*view=kona_playercard"
+                ),
+                self.player_cards,
+            ),
+            (
+                re.compile(r"^/ffl/leagueHistory/\d+\?.*view=kona_playercard"),
+                self.player_cards_history,
+            ),
+            (
+                re.compile(r"^/ffl/seasons/(\d+)/segments/0/leagues/\d+\?"),
+                self.league,
+            ),
+            (
+                re.compile(r"^/ffl/leagueHistory/\d+\?seasonId=(\d+)&"),
+                self.league_history,
+            ),
+            (re.compile(r"^/ffl/seasons/\d+/players\?"), self.players),
+        ]
+
+    def league_history(self, year):
+        return [self.league(year)]
+
+    def player_cards(self):
+        filters = json.loads(
+            self._request.headers.get("x-fantasy-filter") or "{}"
+        )
+        player_ids = (
+            filters.get("players", {}).get("filterIds", {}).get("value", [])
+        )
+        return {
+            "players": [
+                {"id": player_id, "player": _player(player_id)}
+                for player_id in player_ids
+            ]
+        }
+
+    def player_cards_history(self):
+        return [self.player_cards()]
+
+    def league(self, year):
+        year = int(year)
+        team_ids = range(1, self.teams_count + 1)
+        schedule = [
+            {
+                "matchupPeriodId": week,
+                "away": {
+                    "teamId": team_id,
+                    "totalPoints": _points(team_id, week),
+                },
+                "home": {
+                    "teamId": team_id + 1,
+                    "totalPoints": _points(team_id + 1, week),
+                },
+                "winner": "HOME",
+            }
+            for week in range(1, 17)
+            for team_id in team_ids[::2]
+        ]
+        return {
+            "seasonId": year,
+            "scoringPeriodId": 17,
+            "status": {
+                "currentMatchupPeriod": 16,
+                "firstScoringPeriod": 1,
+                "latestScoringPeriod": 17,
+                "finalScoringPeriod": 17,
+            },
+            "settings": {
+                "name": "Benchmark League",
+                "size": self.teams_count,
+                "scheduleSettings": {
+                    "matchupPeriodCount": 13,
+                    "matchupPeriods": {},
+                    "playoffTeamCount": 4,
+                    "divisions": [],
+                },
+                "tradeSettings": {"vetoVotesRequired": 4},
+                "draftSettings": {"keeperCount": 0},
+                "scoringSettings": {
+                    "matchupTieRule": "NONE",
+                    "playoffMatchupTieRule": "NONE",
+                },
+            },
+            "members": [
+                {
+                    "id": f"{{{team_id}}}",
+                    "firstName": "Manager",
+                    "lastName": str(team_id),
+                }
+                for team_id in team_ids
+            ],
+            "teams": [
+                {
+                    "id": team_id,
+                    "abbrev": f"T{team_id}",
+                    "location": "Team",
+                    "nickname": str(team_id),
+                    "divisionId": 0,
+                    "owners": [f"{{{team_id}}}"],
+                    "playoffSeed": team_id,
+                    "rankCalculatedFinal": team_id,
+                    "record": {
+                        "overall": {
+                            "wins": team_id % 14,
+                            "losses": 13 - team_id % 14,
+                            "ties": 0,
+                            "pointsFor": 1000.0 + team_id,
+                            "pointsAgainst": 1000.0 - team_id,
+                            "streakLength": 1,
+                            "streakType": "WIN",
+                        }
+                    },
+                    "roster": {
+                        "entries": [
+                            _roster_entry(player_id)
+                            for player_id in self._players(team_id)
+                        ]
+                    },
+                }
+                for team_id in team_ids
+            ],
+            "schedule": schedule,
+            "draftDetail": {
+                "drafted": True,
+                "picks": [
+                    {
+                        "teamId": team_id,
+                        "playerId": self._drafted(team_id)[round_num - 1],
+                        "roundId": round_num,
+                        "roundPickNumber": team_id,
+                        "bidAmount": 0,
+                        "keeper": False,
+                        "nominatingTeamId": 0,
+                    }
+                    for round_num in range(1, self.players_count + 2)
+                    for team_id in team_ids
+                ],
+            },
+        }
+
+    def players(self):
+        return [
+            {"id": player_id, "fullName": f"Player {player_id}"}
+            for player_id in range(1, self.pro_players_count + 1)
+        ]
+
+    def _players(self, team_id):
+        return [team_id * 100 + slot for slot in range(self.players_count)]
+
+    def _drafted(self, team_id):
+        # The players on the final roster, then one dropped since
+        return self._players(team_id) + [team_id * 100 + self.players_count]
+
+
+def _points(team_id, week):
+    return round(80 + (team_id * 7 + week * 3) % 60, 2)
+
+
+def _roster_entry(player_id):
+    return {
+        "playerId": player_id,
+        "acquisitionType": "DRAFT",
+        "playerPoolEntry": {"player": _player(player_id)},
+    }
+
+
+def _player(player_id):
+    return {
+        "id": player_id,
+        "fullName": f"Player {player_id}",
+        "proTeamId": player_id % 33,
+        "eligibleSlots": [[0, 2, 4, 6, 17][player_id % 5], 20],
+        "injuryStatus": "ACTIVE",
+        "stats": [],
+    }
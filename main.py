@@ -1,131 +1,836 @@
-import numpy as np
-from google.cloud import bigquery, storage
-import dask.dataframe as dd
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
-from src.utils import get_logger, parse_args, parse_yaml, get_data_types
-from src.sleeper import SleeperSeason
-from src.espn import ESPNSeason
+import pandas as pd
+from google.cloud import bigquery
+
+from src.cache import ResponseCache
+from src.client import HttpClient
+from src.gbq import TableCompactor, TableLoader
+from src.landing import LandingZone
+from src.metrics import get_default_metrics, span
+from src.manifest import (
+    LoadManifest,
+    content_hash,
+    partitions_hash,
+    row_hashes,
+)
+from src.storage import (
+    path_exists,
+    read_parquet,
+    remove_path,
+    storage_root,
+    to_arrow_table,
+    write_parquet,
+    WriteQueue,
+)
+from src.utils import (
+    get_logger,
+    parse_args,
+    parse_yaml,
+    get_data_types,
+    compile_key_map,
+)
+from src.sleeper import SleeperSeason, get_nfl_state
+from src.espn import ESPNSeason, fetch_seasons
 
 league_config = parse_yaml("config.yaml")
 
+# The columns added to every table that lacks them when the BigQuery
+# tables are partitioned by year and clustered by league
+PARTITION_COLUMNS = {"league_name": "STRING", "year": "INT64"}
+
+
+def build_http_client(config, cache_path=None):
+    """
+    Build an HttpClient from the http and cache sections of the config
+
+    :param config: The parsed config.yaml
+    :param cache_path: The local directory or fsspec URL to cache API
+        responses in. Defaults to cache.path in the config, and no cache
+        if neither is set.
+    :return: An HttpClient
+    """
+    cache_config = config.get("cache", dict())
+    cache_path = cache_path or cache_config.get("path")
+    response_cache = None
+    if cache_path:
+        response_cache = ResponseCache(
+            cache_path,
+            ttls=cache_config.get("ttls"),
+            default_ttl=cache_config.get("default_ttl", 0),
+        )
+    return HttpClient(cache=response_cache, **config.get("http", dict()))
+
+
+def build_table_compactor(config, storage_root, logger):
+    """
+    Build the TableCompactor of the compaction section of the config
+
+    :param config: The parsed config.yaml
+    :param storage_root: The root the tables are stored under
+    :param logger: A logging.Logger
+    :return: A TableCompactor, or None if compaction is not enabled
+    """
+    compaction_config = dict(config.get("compaction", dict()))
+    if not compaction_config.pop("enabled", False):
+        return None
+    return TableCompactor(
+        storage_root,
+        logger,
+        max_workers=config.get("write_workers", 1),
+        **compaction_config,
+    )
+
 
 class Main:
-    def __init__(self, config):
+    def __init__(
+        self, config, argv=None, args=None, gbq_client=None, http_client=None
+    ):
+        """
+        Initialize the Main class, which extracts every season of a
+            league to GCS and loads the tables into BigQuery
+
+        :param config: The parsed config.yaml
+        :param argv: The command line arguments. Defaults to sys.argv.
+        :param args: The already parsed command line arguments, in
+            place of argv
+        :param gbq_client: The client to load BigQuery tables with, or a
+            stand-in with the methods TableLoader uses. Defaults to a
+            bigquery.Client.
+        :param http_client: The HttpClient to make every request with.
+            Defaults to a client built from the config.
+        """
         # Configurations
         self.config = config
         self.tables_config = self.config.get("tables", dict())
+        # Compile each table's key_map once into an extraction plan
+        self.key_map_plans = {
+            platform: {
+                table: compile_key_map(table_config["key_map"])
+                for table, table_config in tables.items()
+            }
+            for platform, tables in self.tables_config.items()
+        }
         # Sleeper configurations
         self.sleeper_base_url = self.config.get("sleeper_base_url")
+        self.sleeper_concurrency = self.config.get("sleeper_concurrency", 1)
+        # Options of the parquet files written
+        self.parquet_options = self.config.get("parquet", dict())
+        # The number of seasons extracted at once
+        self.season_workers = self.config.get("season_workers", 1)
+        # The number of tables written at once in the background, and
+        # the number of tables extracted ahead of the writes at most
+        self.write_workers = self.config.get("write_workers", 1)
+        self.max_pending_writes = self.config.get("max_pending_writes", 1)
         # ESPN configurations
-        self.espn_start_year = self.config.get("espn_start_year", dict())
-        self.espn_end_year = self.config.get("espn_end_year", dict())
+        self.espn_base_url = self.config.get("espn_base_url")
+        self.espn_concurrency = self.config.get("espn_concurrency", 1)
+        # BigQuery configurations
+        bigquery_config = self.config.get("bigquery", dict())
+        self.partitioned = bigquery_config.get("partitioned", False)
+        self.range_partitioning = {
+            "field": "year",
+            "start": bigquery_config.get("first_year", 2000),
+            "end": bigquery_config.get("last_year", 2100) + 1,
+            "interval": 1,
+        }
         # Command line arguments
         self.config = config
-        self.args = parse_args(self.config["args"])
+        if args is None:
+            args = parse_args(self.config["args"], argv=argv)
+        self.args = args
         self.league_name = self.args["league_name"]
         self.sleeper_season_id = self.args["sleeper_season_id"]
         self.gcs_bucket = self.args["gcs_bucket"]
+        self.storage_root = storage_root(self.gcs_bucket)
         self.gbq_project = self.args["gbq_project"]
         self.gbq_dataset = self.args["gbq_dataset"]
         self.espn_league_id = self.args.get("espn_league_id")
         self.espn_s2 = self.args.get("espn_s2")
         self.espn_swid = self.args.get("espn_swid")
+        # The years of the league's ESPN seasons, which a league of a
+        # batch may set for itself
+        self.espn_start_year = self.args.get("espn_start_year")
+        if self.espn_start_year is None:
+            self.espn_start_year = self.config.get("espn_start_year", 0)
+        self.espn_end_year = self.args.get("espn_end_year")
+        if self.espn_end_year is None:
+            self.espn_end_year = self.config.get("espn_end_year", 0)
+        self.watch = self.args.get("watch", False)
+        self.incremental = self.args.get("incremental", False) or self.watch
+        self.replay = self.args.get("replay", False)
+        self.metrics_path = self.args.get("metrics_path")
+        self.metrics = get_default_metrics()
         self.logger = get_logger(
             "Fantasy Football Stats", level=self.args["log_level"]
         )
-        # Create GCP clients
-        self.gcs_client = storage.Client()
-        self.gbq_client = bigquery.Client()
+        # The HTTP client shared by every season
+        self.http_client = http_client or build_http_client(
+            self.config, cache_path=self.args.get("cache_path")
+        )
+        # The record of every season of the league extracted to GCS
+        self.manifest = LoadManifest(
+            f"{self.storage_root}/_manifests/{self.league_name}.json"
+        )
+        # The raw API responses of every season of the league
+        self.landing_zone = LandingZone(
+            f"{self.storage_root}/_raw/{self.league_name}"
+        )
+        # Create the BigQuery client
+        self.gbq_client = gbq_client or bigquery.Client()
+        self.table_loader = TableLoader(
+            self.gbq_client, self.logger, metrics=self.metrics
+        )
+        # Compacts the files of the BigQuery loads, if enabled
+        self.table_compactor = build_table_compactor(
+            self.config, self.storage_root, self.logger
+        )
+        # The writes of the seasons being extracted, while load_seasons
+        # runs. Otherwise every table is written as soon as extracted.
+        self.write_queue = None
 
     def __call__(self):
+        self.metrics.reset()
+        try:
+            if self.watch and not self.should_run():
+                return
+            failed_seasons = self.extract()
+            with span("load_tables"):
+                load_summary = self.load_tables()
+        finally:
+            if self.metrics_path:
+                self.metrics.write(self.metrics_path)
+                self.logger.info(f"Wrote metrics to {self.metrics_path}")
+        failed_tables = [
+            item["table_id"]
+            for item in load_summary
+            if item["status"] == "failed"
+        ]
+        if failed_seasons:
+            raise RuntimeError(
+                f"Failed to extract seasons: {', '.join(failed_seasons)}"
+            )
+        if failed_tables:
+            raise RuntimeError(
+                f"Failed to load tables: {', '.join(failed_tables)}"
+            )
+
+    def should_run(self):
+        """
+        Check, from Sleeper's state of the NFL season and the manifest,
+            whether a week may have been scored since the current
+            season was last extracted
+
+        :return: A boolean
+        """
+        with span("should_run", league=self.league_name):
+            self.manifest.read()
+            record = self.manifest.get_season(
+                "sleeper", self.sleeper_season_id
+            )
+            if record is None:
+                self.logger.info("The current season was never extracted")
+                return True
+            if record["is_complete"]:
+                self.logger.info("The current season is complete")
+                return False
+            state = get_nfl_state(
+                base_url=self.sleeper_base_url, client=self.http_client
+            )
+            if str(state.get("season")) != str(record["year"]):
+                self.logger.warning(
+                    f'The current season is from {record["year"]}, but the NFL season is {state.get("season")}'
+                )
+                return False
+            if state.get("season_type") == "post":
+                # Every week of the fantasy season has been played
+                return True
+            if state.get("season_type") != "regular":
+                self.logger.info(
+                    f'No games in the {state.get("season_type")} season'
+                )
+                return False
+            played_week = int(state.get("week") or 0) - 1
+            last_completed_week = int(record["last_completed_week"] or 0)
+            if played_week <= last_completed_week:
+                self.logger.info(
+                    f"No week played since week {last_completed_week}"
+                )
+                return False
+            return True
+
+    def extract(self):
+        """
+        Extract every season of the league not extracted yet (and the
+            current season) to GCS
+
+        :return: A list of the IDs of the seasons that failed
+        """
+        with span("extract", league=self.league_name):
+            with span("read_manifest"):
+                self.manifest.read()
+            with span("discover_seasons"):
+                seasons = self.discover_seasons()
+            with span("fetch_espn_seasons"):
+                fetch_seasons(
+                    [
+                        season
+                        for season in seasons
+                        if season.platform == "espn"
+                    ],
+                    concurrency=self.espn_concurrency,
+                    logger=self.logger,
+                )
+            with span("load_seasons"):
+                return self.load_seasons(seasons)
+
+    def load_tables(self):
+        """
+        Load every table from GCS to BigQuery, skipping the tables whose
+            parquet files have not changed since their last load. If
+            compaction is enabled, the files of each load are compacted
+            first and the load reads the compacted files.
+
+        :return: The load summary of TableLoader.load
+        """
+        loads = self.table_loads()
+        if self.table_compactor is not None:
+            with span("compact_tables"):
+                loads = self.table_compactor.compact(loads, self.league_name)
+        return self.table_loader.load(loads)
+
+    def table_loads(self):
+        """
+        List the BigQuery load of every table of the league: one per
+            table, or, if the tables are partitioned, one per table and
+            year replacing only that year's partition
+
+        :return: A list of dictionaries, as taken by TableLoader.load
+        """
+        loads = list()
+        for platform, tables in self.tables_config.items():
+            if self.partitioned:
+                seasons_by_year = self.get_seasons_by_year(platform)
+            for table, table_config in tables.items():
+                table_name = f"{platform}_{table}"
+                table_id = (
+                    f"{self.gbq_project}.{self.gbq_dataset}.{table_name}"
+                )
+                schema = self.get_schema(table_config)
+                if not self.partitioned:
+                    loads.append(
+                        {
+                            "uris": [
+                                f"{self.storage_root}/{table_name}/{self.league_name}/*.parquet"
+                            ],
+                            "table_id": table_id,
+                            "schema": schema,
+                        }
+                    )
+                    continue
+                for year, season_ids in sorted(seasons_by_year.items()):
+                    loads.append(
+                        {
+                            "uris": [
+                                f"{self.storage_root}/{table_name}/{self.league_name}/{season_id}/*.parquet"
+                                for season_id in season_ids
+                            ],
+                            "table_id": f"{table_id}${year}",
+                            "schema": schema,
+                            "range_partitioning": self.range_partitioning,
+                            "clustering_fields": ["league_name"],
+                        }
+                    )
+        return loads
+
+    def get_schema(self, table_config):
+        """
+        Get the columns of a table and their BigQuery data types
+
+        :param table_config: The table's configuration in config.yaml
+        :return: A dictionary of column names to BigQuery data types,
+            with PARTITION_COLUMNS added if the tables are partitioned
+        """
+        schema = get_data_types(table_config["key_map"])
+        if self.partitioned:
+            for col_name, data_type in PARTITION_COLUMNS.items():
+                schema.setdefault(col_name, data_type)
+        return schema
+
+    def get_seasons_by_year(self, platform):
+        """
+        Group the seasons of the league recorded in the manifest for a
+            platform by year
+
+        :param platform: sleeper or espn
+        :return: A dictionary of years to lists of season IDs
+        """
+        seasons_by_year = dict()
+        for record in self.manifest.get_seasons(platform):
+            seasons_by_year.setdefault(int(record["year"]), list()).append(
+                record["season_id"]
+            )
+        return seasons_by_year
+
+    def discover_seasons(self):
+        """
+        Walk the chain of seasons back from the current Sleeper season
+            until a season that is already loaded, requesting only the
+            league of each season to find the previous one. The seasons
+            in the ESPN years are ESPN seasons only if the league has an
+            ESPN league ID; otherwise the chain follows Sleeper's
+            previous seasons to its end.
+
+        :return: A list of SleeperSeason and ESPNSeason objects to load,
+            the current season first
+        """
         season = SleeperSeason(
             self.sleeper_season_id,
             self.league_name,
             base_url=self.sleeper_base_url,
+            concurrency=self.sleeper_concurrency,
+            client=self.http_client,
+            payloads=self.season_payloads("sleeper", self.sleeper_season_id),
         )
+        seasons = list()
         is_season_loaded = False
         while season.season_id and not is_season_loaded:
-            self.load_season(season)
-            if self.espn_start_year < season.year <= self.espn_end_year + 1:
+            seasons.append(season)
+            if season.year is None:
+                # Kept by the season, so loading it doesn't request it
+                # again
+                season.fetch_league()
+            if (
+                self.espn_league_id
+                and self.espn_start_year
+                < season.year
+                <= self.espn_end_year + 1
+            ):
                 season = ESPNSeason(
                     self.espn_league_id,
                     self.league_name,
                     self.espn_s2,
                     self.espn_swid,
                     season.year - 1,
+                    base_url=self.espn_base_url,
+                    client=self.http_client,
+                    payloads=self.season_payloads(
+                        "espn", f"{self.espn_league_id}_{season.year - 1}"
+                    ),
                 )
             else:
+                previous_season_id = getattr(
+                    season, "previous_season_id", None
+                )
                 season = SleeperSeason(
-                    getattr(season, "previous_season_id", None),
+                    previous_season_id,
                     self.league_name,
                     base_url=self.sleeper_base_url,
+                    concurrency=self.sleeper_concurrency,
+                    client=self.http_client,
+                    payloads=self.season_payloads(
+                        "sleeper", previous_season_id
+                    ),
                 )
             is_season_loaded = self.check_season_loaded(season)
+        self.logger.info(
+            f"Discovered {len(seasons)} season(s) to extract: "
+            + ", ".join(str(season.season_id) for season in seasons)
+        )
+        return seasons
 
-        gbq_client = bigquery.Client()
-        for platform, tables in self.tables_config.items():
-            for table, table_config in tables.items():
-                table_name = f"{platform}_{table}"
-                uri = f"gs://{self.gcs_bucket}/{table_name}/{self.league_name}/*.parquet"
-                table_id = (
-                    f"{self.gbq_project}.{self.gbq_dataset}.{table_name}"
-                )
-                data_types = get_data_types(table_config["key_map"])
-                schema = [
-                    bigquery.SchemaField(col_name, data_type)
-                    for col_name, data_type in data_types.items()
-                ]
-                job_config = bigquery.LoadJobConfig(
-                    schema=schema,
-                    write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-                    source_format=bigquery.SourceFormat.PARQUET,
-                )
-                load_job = gbq_client.load_table_from_uri(
-                    uri, table_id, job_config=job_config
+    def season_payloads(self, platform, season_id):
+        """
+        Get the object a season's requests go through: a recorder of
+            their responses, or in replay mode a replayer answering them
+            from the landing zone
+
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        :return: A SeasonRecorder or SeasonReplayer
+        """
+        if self.replay:
+            return self.landing_zone.replayer(platform, season_id)
+        return self.landing_zone.recorder(platform, season_id)
+
+    def load_seasons(self, seasons):
+        """
+        Extract seasons to GCS in parallel, while a write queue
+            converts and writes the tables already extracted. A season
+            that fails does not stop the others, and its seasons table
+            is removed so the next run extracts it again.
+
+        :param seasons: The list returned by discover_seasons
+        :return: A list of the IDs of the seasons that failed
+        """
+        since_week = None
+        if self.incremental and not self.replay and seasons:
+            since_week = self.get_high_water_mark(seasons[0])
+        if (
+            self.watch
+            and since_week is not None
+            and len(seasons) == 1
+            and (seasons[0].last_completed_week or 0) <= since_week
+        ):
+            # The week was played but the league has not scored it yet
+            self.logger.info(
+                f"No week scored since week {since_week}, skipped extraction"
+            )
+            return list()
+        failed_seasons = list()
+        self.write_queue = WriteQueue(
+            max_workers=self.write_workers,
+            max_pending=self.max_pending_writes,
+        )
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.season_workers
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        self.load_season,
+                        season,
+                        since_week=since_week if i == 0 else None,
+                    ): season
+                    for i, season in enumerate(seasons)
+                }
+                for future in as_completed(futures):
+                    season = futures[future]
+                    try:
+                        self.manifest.record_season(
+                            season,
+                            future.result(),
+                            partitioned=self.partitioned,
+                        )
+                    except Exception:
+                        self.logger.exception(
+                            f'Failed to extract season "{season.season_id}" from {season.platform}'
+                        )
+                        remove_path(
+                            f"{self.storage_root}/{season.platform}_seasons/{self.league_name}/{season.season_id}"
+                        )
+                        self.manifest.remove_season(
+                            season.platform, season.season_id
+                        )
+                        failed_seasons.append(str(season.season_id))
+        finally:
+            self.write_queue.shutdown()
+            self.write_queue = None
+        return failed_seasons
+
+    def check_season_loaded(self, season_obj):
+        """
+        Check whether a season was already extracted to GCS, from the
+            manifest or, for a league extracted before it had one, by
+            checking for the season's files. In replay mode, every
+            season in the landing zone is extracted again, so only a
+            season missing from it counts as loaded.
+
+        :param season_obj: A SleeperSeason or ESPNSeason
+        :return: A boolean
+        """
+        with span(
+            "check_season_loaded",
+            platform=season_obj.platform,
+            season_id=season_obj.season_id,
+        ):
+            if self.replay:
+                return not self.landing_zone.has_season(
+                    season_obj.platform, season_obj.season_id
                 )
-                load_job.result()  # Waits for the job to complete.
-                self.logger.info(
-                    f'Loaded data from location "{uri}" to table "{table_id}"'
+            if self.manifest.exists:
+                return self.manifest.is_loaded(
+                    season_obj.platform,
+                    season_obj.season_id,
+                    partitioned=self.partitioned,
                 )
+            if self.partitioned:
+                # The files written before the league had a manifest
+                # lack the columns the tables are partitioned by
+                return False
+            return path_exists(
+                f"{self.storage_root}/{season_obj.platform}_seasons/{self.league_name}/{season_obj.season_id}"
+            )
 
-    def check_season_loaded(self, season_obj):
-        season_prefix = f"{season_obj.platform}_seasons/{self.league_name}/{season_obj.season_id}"
-        season_blob_iterator = self.gcs_client.list_blobs(
-            self.gcs_bucket, prefix=season_prefix
-        )
-        season_blobs_count = sum(
-            [page.num_items for page in season_blob_iterator.pages]
+    def get_high_water_mark(self, season_obj):
+        """
+        Read the last completed week already stored for a season
+
+        :param season_obj: A SleeperSeason
+        :return: The stored last completed week (0 if no week had been
+            completed), or None if the season has not been stored
+        """
+        if self.manifest.exists:
+            if not self.manifest.is_loaded(
+                season_obj.platform,
+                season_obj.season_id,
+                partitioned=self.partitioned,
+            ):
+                return None
+            record = self.manifest.get_season(
+                season_obj.platform, season_obj.season_id
+            )
+            return int(record["last_completed_week"] or 0)
+        if self.partitioned:
+            return None
+        seasons_path = f"{self.storage_root}/{season_obj.platform}_seasons/{self.league_name}/{season_obj.season_id}"
+        stored_season = read_parquet(
+            seasons_path, columns=["last_completed_week"]
         )
-        is_loaded = True if season_blobs_count > 0 else False
-        return is_loaded
+        if stored_season is None or stored_season.num_rows == 0:
+            return None
+        last_completed_week = stored_season.column(0).to_pylist()[0]
+        return int(last_completed_week or 0)
+
+    def load_season(self, season_obj, since_week=None):
+        """
+        Extract every table of a season to GCS
 
-    def load_season(self, season_obj):
+        :param season_obj: A SleeperSeason or ESPNSeason
+        :param since_week: If given, only the weeks completed after
+            this week are extracted for the tables partitioned by week,
+            and only their week partitions are overwritten
+        :return: A dictionary of table names to their path, row count
+            and content hash (and partitions, for a partitioned table),
+            as recorded in the manifest
+        """
         self.logger.info(
             f'Started extracting season "{season_obj.season_id}" from {season_obj.platform} to GCS'
         )
+        record = self.manifest.get_season(
+            season_obj.platform, season_obj.season_id
+        )
+        previous_tables = (record or dict()).get("tables", dict())
+        tables = dict()
+        pending_writes = list()
         platform_tables_config = self.tables_config[season_obj.platform]
-        for table, table_config in platform_tables_config.items():
-            method_name = table_config["method"]
-            method = season_obj.__getattribute__(method_name)
-            df = method(key_map=table_config.get("key_map"))
-            df = df.replace("", np.nan)
-            dask_df = dd.from_pandas(df, npartitions=1)
-            gcs_path = f"gs://{self.gcs_bucket}/{season_obj.platform}_{table}/{self.league_name}/{season_obj.season_id}"
-            schema = get_data_types(table_config.get("key_map"))
-            dd.to_parquet(
-                dask_df,
-                path=gcs_path,
-                write_index=False,
-                overwrite=True,
-                schema=schema,
-                engine="pyarrow",
-            )
-            self.logger.info(f"Extracted to {gcs_path}")
+        with span(
+            "load_season",
+            platform=season_obj.platform,
+            season_id=season_obj.season_id,
+        ):
+            try:
+                for table, table_config in platform_tables_config.items():
+                    with span("load_table", table=table):
+                        table_record = self.load_table(
+                            season_obj,
+                            table,
+                            table_config,
+                            since_week=since_week,
+                            previous_record=previous_tables.get(table),
+                            pending_writes=pending_writes,
+                        )
+                    if table_record is not None:
+                        tables[table] = table_record
+            finally:
+                # Even if the season failed, so that no write finishes
+                # after its files are removed
+                with span("wait_for_writes"):
+                    wait(pending_writes)
+                # Keep whatever was received, even if the season failed
+                with span("land_payloads"):
+                    season_obj.payloads.flush()
+                season_obj.release()
+            for future in pending_writes:
+                future.result()
         self.logger.info(
             f'Finished extracting season "{season_obj.season_id}" from {season_obj.platform} to GCS\n'
         )
+        return tables
+
+    def load_table(
+        self,
+        season_obj,
+        table,
+        table_config,
+        since_week=None,
+        previous_record=None,
+        pending_writes=None,
+    ):
+        """
+        Extract a table of a season to GCS. The table's method returns a
+            DataFrame or, for a partitioned table, may yield DataFrames
+            each holding whole partitions, which are then written one
+            after another, with no more in memory than the write queue
+            lets wait.
+
+        :param season_obj: A SleeperSeason or ESPNSeason
+        :param table: The name of the table
+        :param table_config: The table's configuration in config.yaml
+        :param since_week: If given and the table is partitioned by
+            week, only the weeks completed after this week are
+            extracted
+        :param previous_record: The manifest's record of the table from
+            the last run, if any. The table (or partition) is not
+            written again if its content hash has not changed since.
+        :param pending_writes: A list to add the writes submitted to the
+            write queue to. Defaults to writing the table before
+            returning.
+        :return: The table's record for the manifest (see load_season),
+            or None if there was nothing to extract
+        """
+        method = season_obj.__getattribute__(table_config["method"])
+        partition_by = table_config.get("partition_by")
+        kwargs = dict()
+        if since_week is not None and partition_by == "week":
+            weeks = range(
+                max(since_week + 1, season_obj.start_week),
+                (season_obj.last_completed_week or 0) + 1,
+            )
+            if not weeks:
+                self.logger.info(f'No new weeks to extract for "{table}"')
+                return previous_record
+            kwargs["weeks"] = weeks
+        frames = method(
+            key_map=self.key_map_plans[season_obj.platform][table],
+            **kwargs,
+        )
+        gcs_path = f"{self.storage_root}/{season_obj.platform}_{table}/{self.league_name}/{season_obj.season_id}"
+        schema = self.get_schema(table_config)
+        previous_record = previous_record or dict()
+        if not partition_by:
+            if isinstance(frames, pd.DataFrame):
+                df = frames
+            else:
+                df = pd.concat(frames, ignore_index=True)
+            df = self.add_partition_columns(df, season_obj)
+            with span("hash"):
+                hashes = row_hashes(df)
+            table_hash = content_hash(list(df.columns), hashes, schema)
+            if table_hash == previous_record.get("content_hash"):
+                self.logger.info(f"Unchanged, skipped {gcs_path}")
+                return previous_record
+            self.write_table(df, schema, gcs_path, pending_writes)
+            return {
+                "path": gcs_path,
+                "rows": len(df),
+                "content_hash": table_hash,
+            }
+        previous_partitions = previous_record.get("partitions", dict())
+        partitions = dict()
+        if since_week is not None:
+            partitions.update(previous_partitions)
+        elif not previous_partitions:
+            remove_path(gcs_path)
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+        for df in frames:
+            df = self.add_partition_columns(df, season_obj)
+            with span("hash"):
+                columns = list(df.columns)
+                hashes = row_hashes(df)
+            for value, index in df.groupby(partition_by).indices.items():
+                partition = f"{partition_by}_{value}"
+                partition_hash = content_hash(columns, hashes[index], schema)
+                partitions[partition] = {
+                    "rows": len(index),
+                    "content_hash": partition_hash,
+                }
+                previous_partition = previous_partitions.get(partition, dict())
+                if partition_hash == previous_partition.get("content_hash"):
+                    self.logger.info(
+                        f"Unchanged, skipped {gcs_path}/{partition}"
+                    )
+                    continue
+                self.write_table(
+                    df.iloc[index],
+                    schema,
+                    f"{gcs_path}/{partition}",
+                    pending_writes,
+                )
+            del df, hashes
+        # Remove the partitions a full extraction no longer has
+        for partition in previous_partitions.keys() - partitions.keys():
+            remove_path(f"{gcs_path}/{partition}")
+        return {
+            "path": gcs_path,
+            "rows": sum(p["rows"] for p in partitions.values()),
+            "content_hash": partitions_hash(partitions),
+            "partitions": partitions,
+        }
+
+    def add_partition_columns(self, df, season_obj):
+        """
+        Add the columns the BigQuery tables are partitioned and
+            clustered by to a table of a season, if they are and the
+            table lacks them
+
+        :param df: The DataFrame of the table
+        :param season_obj: A SleeperSeason or ESPNSeason
+        :return: A DataFrame
+        """
+        if not self.partitioned:
+            return df
+        partition_values = {
+            "league_name": self.league_name,
+            "year": season_obj.year,
+        }
+        return df.assign(
+            **{
+                col_name: partition_values[col_name]
+                for col_name in PARTITION_COLUMNS
+                if col_name not in df
+            }
+        )
+
+    def write_table(self, df, schema, gcs_path, pending_writes=None):
+        """
+        Convert a table to Arrow and write it to a parquet directory, in
+            the background if there is a write queue
+
+        :param df: The DataFrame of the table
+        :param schema: A dictionary of column names to BigQuery data
+            types
+        :param gcs_path: The path of the directory under the storage
+            root
+        :param pending_writes: A list to add the write to if it is
+            submitted to the write queue. Defaults to writing the table
+            before returning.
+        :return: None
+        """
+        if self.write_queue is None or pending_writes is None:
+            self.write_parquet(self.to_arrow_table(df, schema), gcs_path)
+            return
+        pending_writes.append(
+            self.write_queue.submit(
+                lambda: self.write_parquet(
+                    self.to_arrow_table(df, schema), gcs_path
+                )
+            )
+        )
+
+    def to_arrow_table(self, df, schema):
+        """
+        Convert a table to Arrow to write it
+
+        :param df: The DataFrame of the table
+        :param schema: A dictionary of column names to BigQuery data
+            types
+        :return: A pyarrow.Table
+        """
+        with span("convert") as s:
+            arrow_table = to_arrow_table(df, schema)
+            s.add(rows=arrow_table.num_rows)
+        return arrow_table
+
+    def write_parquet(self, arrow_table, gcs_path):
+        """
+        Write an Arrow table to a parquet directory, replacing anything
+            already there, with the options in the parquet section of
+            the config
+
+        :param arrow_table: The pyarrow.Table to write
+        :param gcs_path: The path of the directory under the storage
+            root
+        :return: None
+        """
+        write_parquet(arrow_table, gcs_path, **self.parquet_options)
+        self.logger.info(f"Extracted to {gcs_path}")
 
 
 if __name__ == "__main__":
     m = Main(league_config)
-    m()
+    try:
+        m()
+    finally:
+        m.http_client.close()
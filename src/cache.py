@@ -0,0 +1,143 @@
+import gzip
+import hashlib
+import json
+import math
+import re
+import time
+
+import fsspec
+
+PERMANENT = math.inf
+
+
+class ResponseCache:
+    def __init__(self, path, ttls=None, default_ttl=0):
+        """
+        Initialize the ResponseCache class, a persistent store of API
+            responses keyed by URL
+
+        :param path: The local directory or fsspec URL (e.g.
+            gs://bucket/prefix) to keep the responses in
+        :param ttls: A list of dictionaries mapping a regular expression
+            (searched for in the URL) to the number of seconds a
+            response to a matching URL stays fresh. The first match
+            wins. Format:
+            [{'pattern': '/matchups/\\d+$', 'ttl': 600}]
+        :param default_ttl: The number of seconds a response to a URL
+            matching none of ttls stays fresh. A TTL of 0 keeps the
+            response only to revalidate it with a conditional request.
+        """
+        self.fs, self.path = fsspec.core.url_to_fs(path)
+        self.ttls = [
+            (re.compile(ttl["pattern"]), ttl["ttl"]) for ttl in ttls or list()
+        ]
+        self.default_ttl = default_ttl
+
+    def ttl_for(self, url):
+        """
+        Get the TTL configured for a URL
+
+        :param url: The URL of a request
+        :return: The number of seconds a response stays fresh
+        """
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+    def get(self, url):
+        """
+        Get the stored response to a URL, fresh or not
+
+        :param url: The URL of a request
+        :return: A dictionary with the keys body, stored_at, expires_at,
+            etag and last_modified; or None if nothing is stored
+        """
+        try:
+            with self.fs.open(self._entry_path(url), "rb") as f:
+                return json.loads(gzip.decompress(f.read()))
+        except (OSError, EOFError, ValueError):
+            # Missing, or a partial write from an interrupted run
+            return None
+
+    def put(self, url, body, ttl=None, etag=None, last_modified=None):
+        """
+        Store the response to a URL
+
+        :param url: The URL of the request
+        :param body: The parsed body of the response
+        :param ttl: The number of seconds the response stays fresh, or
+            PERMANENT. Defaults to the TTL configured for the URL.
+        :param etag: The ETag header of the response
+        :param last_modified: The Last-Modified header of the response
+        :return: None
+        """
+        ttl = self.ttl_for(url) if ttl is None else ttl
+        stored_at = time.time()
+        entry = {
+            "url": url,
+            "body": body,
+            "stored_at": stored_at,
+            "expires_at": None if ttl == PERMANENT else stored_at + ttl,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+        entry_path = self._entry_path(url)
+        self.fs.makedirs(entry_path.rsplit("/", 1)[0], exist_ok=True)
+        with self.fs.open(entry_path, "wb") as f:
+            f.write(gzip.compress(json.dumps(entry).encode()))
+
+    def persist(self, url):
+        """
+        Keep the stored response to a URL forever, e.g. once it is
+            known to belong to a completed season
+
+        :param url: The URL of a request
+        :return: None
+        """
+        entry = self.get(url)
+        if entry and entry["expires_at"] is not None:
+            self.put(
+                url,
+                entry["body"],
+                ttl=PERMANENT,
+                etag=entry["etag"],
+                last_modified=entry["last_modified"],
+            )
+
+    @staticmethod
+    def is_fresh(entry):
+        """
+        Check whether a stored response can be used without asking the
+            server
+
+        :param entry: A dictionary returned by get
+        :return: A boolean
+        """
+        return entry["expires_at"] is None or entry["expires_at"] > time.time()
+
+    @staticmethod
+    def conditional_headers(entry):
+        """
+        Build the headers of a conditional request revalidating a
+            stored response
+
+        :param entry: A dictionary returned by get, or None
+        :return: A dictionary of headers
+        """
+        headers = dict()
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _entry_path(self, url):
+        """
+        Get the path a response to a URL is stored at
+
+        :param url: The URL of a request
+        :return: A path within the cache's filesystem
+        """
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        return f"{self.path}/{digest[:2]}/{digest}.json.gz"
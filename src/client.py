@@ -0,0 +1,496 @@
+import asyncio
+import atexit
+import json
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.cache import ResponseCache
+from src.metrics import span
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class TokenBucket:
+    def __init__(self, requests_per_second, burst=None):
+        """
+        Initialize the TokenBucket class
+
+        :param requests_per_second: The rate at which tokens are added
+            to the bucket
+        :param burst: The maximum number of tokens the bucket holds,
+            i.e. the number of requests that may be made back to back
+            after an idle period. Defaults to one second's worth.
+        """
+        self.rate = float(requests_per_second)
+        self.capacity = float(burst or max(requests_per_second, 1))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token from the bucket, going into debt if it is empty
+
+        :return: The number of seconds the caller must wait before
+            making its request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated_at) * self.rate,
+            )
+            self.updated_at = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """
+        Block until a request may be made
+
+        :return: None
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+
+class HttpClient:
+    def __init__(
+        self,
+        timeout=10,
+        max_retries=5,
+        backoff_factor=0.5,
+        backoff_max=30,
+        pool_size=16,
+        rate_limits=None,
+        cache=None,
+    ):
+        """
+        Initialize the HttpClient class, a pooled HTTP client shared by
+            every request the pipeline makes
+
+        :param timeout: The number of seconds to wait for a response
+            before giving up on an attempt
+        :param max_retries: The number of times to retry a request
+            that timed out, failed to connect, or was answered with a
+            429 or 5xx status
+        :param backoff_factor: The base number of seconds of the
+            exponential backoff between retries
+        :param backoff_max: The maximum number of seconds to wait
+            between retries
+        :param pool_size: The number of connections to keep alive per
+            host
+        :param rate_limits: A dictionary mapping a platform to the
+            keyword arguments of its TokenBucket. Format:
+            {'sleeper': {'requests_per_second': 10, 'burst': 20}}
+        :param cache: A ResponseCache to serve fresh responses from and
+            store new ones in
+        """
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.rate_limiters = {
+            platform: TokenBucket(**limit)
+            for platform, limit in (rate_limits or dict()).items()
+        }
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # The event loop making the concurrent requests of
+        # get_json_many, run by a thread of its own and started on
+        # first use, with its aiohttp session and the threads its cache
+        # reads and writes run on
+        self._loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+        self._async_session = None
+        self._cache_executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close the pooled sessions and stop the event loop, if started.
+            The client starts them again if it is used afterwards.
+
+        :return: None
+        """
+        self.session.close()
+        with self._loop_lock:
+            loop, self._loop = self._loop, None
+            thread, self._loop_thread = self._loop_thread, None
+            executor, self._cache_executor = self._cache_executor, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(
+            self._close_async_session(), loop
+        ).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        executor.shutdown()
+
+    def get_json(
+        self, url, platform=None, ttl=None, headers=None, cookies=None
+    ):
+        """
+        Make a GET request, retrying with backoff when allowed. A fresh
+            cached response is returned without a request, and a stale
+            one is revalidated with a conditional request.
+
+        :param url: The URL to request
+        :param platform: The platform the URL belongs to, used to pick
+            its rate limiter
+        :param ttl: The number of seconds to cache the response for, or
+            PERMANENT. Defaults to the TTL configured for the URL.
+        :param headers: A dictionary of headers to send with the
+            request (e.g. ESPN's x-fantasy-filter). The response is
+            cached under the URL together with them.
+        :param cookies: A dictionary of cookies to send with the
+            request (e.g. ESPN's espn_s2 and SWID), on the same pooled
+            session as every other request
+        :return: The parsed body of the response
+        """
+        cache_key = _cache_key(url, headers)
+        with span("fetch", platform=platform, endpoint=endpoint(url)) as s:
+            entry = self._cached(cache_key)
+            if entry and ResponseCache.is_fresh(entry):
+                s.add(cache_hits=1)
+                return entry["body"]
+            request_headers = {
+                **(headers or dict()),
+                **ResponseCache.conditional_headers(entry),
+            }
+            attempt = 0
+            while True:
+                self._rate_limiter(platform).acquire()
+                retry_headers = dict()
+                s.add(requests=1)
+                try:
+                    response = self.session.get(
+                        url,
+                        headers=request_headers,
+                        cookies=cookies,
+                        timeout=self.timeout,
+                    )
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt >= self.max_retries:
+                        raise
+                else:
+                    s.add(bytes_in=len(response.content))
+                    if (
+                        response.status_code not in RETRY_STATUSES
+                        or attempt >= self.max_retries
+                    ):
+                        if response.status_code == 304 and entry:
+                            s.add(cache_hits=1)
+                            body = entry["body"]
+                        else:
+                            response.raise_for_status()
+                            body = json.loads(response.content)
+                        self._store(cache_key, body, ttl, response.headers)
+                        return body
+                    retry_headers = response.headers
+                time.sleep(self._backoff(attempt, retry_headers))
+                attempt += 1
+
+    def get_json_many(self, urls, platform=None, concurrency=1, ttl=None):
+        """
+        Make several GET requests, optionally concurrently
+
+        :param urls: The URLs to request
+        :param platform: The platform the URLs belong to, used to pick
+            their rate limiter
+        :param concurrency: The maximum number of requests in flight at
+            once. A concurrency of 1 makes the requests one after
+            another on the pooled session.
+        :param ttl: The number of seconds to cache the responses for,
+            or PERMANENT. Defaults to the TTL configured for each URL.
+        :return: A list of the parsed responses, in the same order as
+            urls
+        """
+        if concurrency <= 1:
+            return [
+                self.get_json(url, platform=platform, ttl=ttl) for url in urls
+            ]
+        # The coroutine runs in a copy of the caller's context, so its
+        # spans are labelled like the caller's
+        return asyncio.run_coroutine_threadsafe(
+            self._async_get_json_many(urls, platform, concurrency, ttl),
+            self._event_loop(),
+        ).result()
+
+    def persist(self, url):
+        """
+        Keep the cached response to a URL forever
+
+        :param url: A URL that has been requested
+        :return: None
+        """
+        if self.cache:
+            self.cache.persist(url)
+
+    def _event_loop(self):
+        """
+        Get the event loop making the concurrent requests, starting it
+            in a thread of its own on first use
+
+        :return: An asyncio event loop
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._cache_executor = ThreadPoolExecutor(
+                    max_workers=self.pool_size,
+                    thread_name_prefix="HttpClient cache",
+                )
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(
+                    target=self._loop.run_forever,
+                    name="HttpClient event loop",
+                    daemon=True,
+                )
+                self._loop_thread.start()
+            return self._loop
+
+    def _aiohttp_session(self):
+        """
+        Get the aiohttp session shared by every call to get_json_many,
+            keeping up to pool_size connections per host alive between
+            calls. Only called on the event loop.
+
+        :return: An aiohttp.ClientSession
+        """
+        if self._async_session is None:
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=0, limit_per_host=self.pool_size
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._async_session
+
+    async def _close_async_session(self):
+        """
+        Close the aiohttp session, if opened
+
+        :return: None
+        """
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    async def _async_get_json_many(self, urls, platform, concurrency, ttl):
+        """
+        Helper function to make the requests of get_json_many on the
+            event loop, with at most concurrency requests in flight
+
+        :param urls: The URLs to request
+        :param platform: The platform the URLs belong to
+        :param concurrency: The maximum number of requests in flight at
+            once
+        :param ttl: The number of seconds to cache the responses for
+        :return: A list of the parsed responses, in the same order as
+            urls
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        session = self._aiohttp_session()
+        return await asyncio.gather(
+            *[
+                self._async_get_json(session, semaphore, url, platform, ttl)
+                for url in urls
+            ]
+        )
+
+    async def _async_get_json(self, session, semaphore, url, platform, ttl):
+        """
+        The asyncio counterpart of get_json. The cache is read and
+            written on the cache threads, so a slow cache (e.g. on GCS)
+            doesn't hold up the other requests on the event loop.
+
+        :param session: An aiohttp.ClientSession
+        :param semaphore: An asyncio.Semaphore bounding the requests in
+            flight
+        :param url: The URL to request
+        :param platform: The platform the URL belongs to
+        :param ttl: The number of seconds to cache the response for
+        :return: The parsed body of the response
+        """
+        loop = asyncio.get_running_loop()
+        with span("fetch", platform=platform, endpoint=endpoint(url)) as s:
+            entry = await loop.run_in_executor(
+                self._cache_executor, self._cached, url
+            )
+            if entry and ResponseCache.is_fresh(entry):
+                s.add(cache_hits=1)
+                return entry["body"]
+            request_headers = ResponseCache.conditional_headers(entry)
+            attempt = 0
+            async with semaphore:
+                while True:
+                    await asyncio.sleep(self._rate_limiter(platform).reserve())
+                    headers = dict()
+                    s.add(requests=1)
+                    try:
+                        async with session.get(
+                            url, headers=request_headers
+                        ) as response:
+                            headers = response.headers
+                            content = await response.read()
+                            s.add(bytes_in=len(content))
+                            if (
+                                response.status not in RETRY_STATUSES
+                                or attempt >= self.max_retries
+                            ):
+                                if response.status == 304 and entry:
+                                    s.add(cache_hits=1)
+                                    body = entry["body"]
+                                else:
+                                    response.raise_for_status()
+                                    body = json.loads(content)
+                                await loop.run_in_executor(
+                                    self._cache_executor,
+                                    self._store,
+                                    url,
+                                    body,
+                                    ttl,
+                                    headers,
+                                )
+                                return body
+                    except (
+                        aiohttp.ClientConnectionError,
+                        asyncio.TimeoutError,
+                    ):
+                        if attempt >= self.max_retries:
+                            raise
+                    await asyncio.sleep(self._backoff(attempt, headers))
+                    attempt += 1
+
+    def _cached(self, url):
+        """
+        Get the cached response to a URL
+
+        :param url: The URL of a request
+        :return: A cache entry, or None if there is no cache or nothing
+            is cached for the URL
+        """
+        return self.cache.get(url) if self.cache else None
+
+    def _store(self, url, body, ttl, headers):
+        """
+        Cache the response to a URL, if there is a cache
+
+        :param url: The URL of the request
+        :param body: The parsed body of the response
+        :param ttl: The number of seconds to cache the response for
+        :param headers: The headers of the response
+        :return: None
+        """
+        if self.cache:
+            self.cache.put(
+                url,
+                body,
+                ttl=ttl,
+                etag=headers.get("ETag"),
+                last_modified=headers.get("Last-Modified"),
+            )
+
+    def _rate_limiter(self, platform):
+        """
+        Get the rate limiter of a platform
+
+        :param platform: The platform of a request
+        :return: A TokenBucket, or a stand-in that never waits if the
+            platform is not rate limited
+        """
+        return self.rate_limiters.get(platform, _UNLIMITED)
+
+    def _backoff(self, attempt, headers):
+        """
+        Compute the wait before a retry using exponential backoff with
+            full jitter, honouring a Retry-After header if one was sent
+
+        :param attempt: The number of attempts already retried
+        :param headers: The headers of the failed response (empty if
+            no response was received)
+        :return: The number of seconds to wait
+        """
+        retry_after = headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        ceiling = min(self.backoff_max, self.backoff_factor * 2**attempt)
+        return random.uniform(0, ceiling)
+
+
+class _Unlimited:
+    def reserve(self):
+        return 0.0
+
+    def acquire(self):
+        pass
+
+
+_UNLIMITED = _Unlimited()
+_default_client = None
+
+# A path segment that identifies a resource rather than naming an
+# endpoint, i.e. one containing a digit that isn't an API version
+_ID_SEGMENT = re.compile(r"(?<=/)(?!v\d+(?:/|$))[^/]*\d[^/]*")
+
+
+def endpoint(url):
+    """
+    Get the endpoint of a URL, its path with the IDs replaced, to
+        group the requests to the same endpoint together
+
+    :param url: A URL
+    :return: A string, e.g. /v1/league/{id}/matchups/{id}
+    """
+    return _ID_SEGMENT.sub("{id}", urlsplit(url).path)
+
+
+def _cache_key(url, headers=None):
+    """
+    Get the key the response to a request is cached under
+
+    :param url: The URL of the request
+    :param headers: The headers sent with the request, if any
+    :return: The URL, followed by the headers if any were sent
+    """
+    if not headers:
+        return url
+    return f"{url}\n{json.dumps(headers, sort_keys=True)}"
+
+
+def get_default_client():
+    """
+    Get the client used by requests that were not given one, closed
+        when the process exits
+
+    :return: An HttpClient
+    """
+    global _default_client
+    if _default_client is None:
+        _default_client = HttpClient()
+        atexit.register(_default_client.close)
+    return _default_client
@@ -1,12 +1,85 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
 import pandas as pd
 
-from espn_api.football import League
+from espn_api.base_settings import BaseSettings
+from espn_api.football import Pick, Player, Team
+
+from src.cache import PERMANENT
+from src.client import get_default_client
+from src.landing import MissingPayloadError, PayloadClient
+from src.utils import compile_key_map, format_columns, to_dataframe
+
+BASE_URL = "https://fantasy.espn.com/apis/v3/games/ffl"
+
+# The views of a league the tables are built from: its settings, teams
+# (with their owners and rosters), schedule and draft. espn_api's League
+# also requests every active NFL player (players_wl) just to name the
+# draft picks, which the rosters and player cards already do.
+LEAGUE_VIEWS = ("mDraftDetail", "mMatchup", "mRoster", "mSettings", "mTeam")
+
+# The dtype each BigQuery data type of a matchups column is built with
+PANDAS_DTYPES = {
+    "INT64": "int64",
+    "INTEGER": "int64",
+    "FLOAT64": "float64",
+    "FLOAT": "float64",
+}
+
+
+def fetch_seasons(seasons, concurrency=1, logger=None):
+    """
+    Request the leagues of several ESPN seasons concurrently, ahead of
+        extracting them one table at a time. A season whose request
+        fails is logged, then left to request again (and fail) when it
+        is extracted.
+
+    :param seasons: A list of ESPNSeason objects
+    :param concurrency: The maximum number of requests in flight at once
+    :param logger: A logging.Logger to log the failed requests with.
+        Defaults to raising the first failure.
+    :return: None
+    """
+    if not seasons:
+        return
+
+    def fetch_league(season):
+        try:
+            season.fetch_league()
+        except Exception:
+            if logger is None:
+                raise
+            logger.exception(
+                f'Failed to request ESPN season "{season.season_id}", retrying when it is extracted'
+            )
 
-from src.utils import format_response
+    with ThreadPoolExecutor(
+        max_workers=max(min(concurrency, len(seasons)), 1)
+    ) as executor:
+        list(executor.map(fetch_league, seasons))
 
 
 class ESPNSeason:
-    def __init__(self, league_id, league_name, s2, swid, year):
+    # Names and positions of the players seen in any season, by player
+    # ID. The same players are drafted year after year, so every season
+    # shares them.
+    players = dict()
+    _players_lock = threading.Lock()
+
+    def __init__(
+        self,
+        league_id,
+        league_name,
+        s2,
+        swid,
+        year,
+        base_url=BASE_URL,
+        client=None,
+        payloads=None,
+    ):
         """
         Initialize the ESPNSeason class
 
@@ -17,24 +90,120 @@ class ESPNSeason:
         :param s2: Your ESPN s2 cookie (used for authentication)
         :param swid: Your ESPN swid cookie (used for authentication)
         :param year: The year of the season
+        :param base_url: The base URL of ESPN's fantasy football API
+        :param client: The HttpClient to make requests with. Defaults
+            to a client shared by the whole process.
+        :param payloads: A SeasonRecorder to record the responses with,
+            or a SeasonReplayer to answer the requests from the landing
+            zone
         """
         self.league_id = league_id
         self.league_name = league_name
         self.platform = "espn"
         self.s2 = s2
         self.swid = swid
+        self.cookies = None
+        if s2 and swid:
+            self.cookies = {"espn_s2": s2, "SWID": swid}
         self.year = year
         self.season_id = f"{self.league_id}_{self.year}"
-        self.response = None
+        self.base_url = base_url
+        self.client = client or get_default_client()
+        self.payloads = payloads
+        if payloads is not None:
+            self.client = PayloadClient(self.client, payloads)
+        self.league = None
         self.season = None
         self.start_week = None
         self.regular_season_weeks = None
         self.team_objs = None
+        self.rosters = None
         self.teams = None
         self.draft_picks = None
-        self.player_map = None
         self.matchups = None
 
+    def release(self):
+        """
+        Drop the tables and API response kept by the season once it
+            has been extracted, keeping what identifies it
+
+        :return: None
+        """
+        self.league = None
+        self.season = None
+        self.team_objs = None
+        self.rosters = None
+        self.teams = None
+        self.draft_picks = None
+        self.matchups = None
+
+    def fetch_league(self):
+        """
+        Request the settings, teams, schedule and draft of the season
+            from ESPN in a single request, unless already requested.
+            ESPN seasons precede the Sleeper seasons, so are complete
+            and cached forever.
+
+        :return: The league of the API response
+        """
+        if self.league is not None:
+            return self.league
+        url = self._league_url(view=LEAGUE_VIEWS)
+        try:
+            response = self.client.get_json(
+                url,
+                platform=self.platform,
+                ttl=PERMANENT,
+                cookies=self.cookies,
+            )
+        except MissingPayloadError:
+            # The season may have been landed by separate requests
+            response = self._replay_league(url)
+        self.league = _unwrap_league(response)
+        return self.league
+
+    def _league_url(self, **params):
+        """
+        Build the URL of a request for the season's league
+
+        :param params: The query parameters of the request. A list
+            value repeats the parameter.
+        :return: A URL
+        """
+        if self.year < 2018:
+            # ESPN serves the older seasons from the league's history
+            path = f"/leagueHistory/{self.league_id}"
+            params = {"seasonId": self.year, **params}
+        else:
+            path = f"/seasons/{self.year}/segments/0/leagues/{self.league_id}"
+        return f"{self.base_url}{path}?{urlencode(params, doseq=True)}"
+
+    def _replay_league(self, url):
+        """
+        Merge the responses stored in the landing zone to every request
+            for the season's league but the player cards, as landed
+            before the views were requested at once
+
+        :param url: The URL of the request for the league
+        :return: The merged league
+        :raises MissingPayloadError: If no such response is stored
+        """
+        path = urlsplit(url).path
+        league = dict()
+        for record in self.payloads.landing_zone.read(
+            self.platform, self.season_id
+        ):
+            if (
+                urlsplit(record["url"]).path == path
+                and "kona_playercard" not in record["url"]
+            ):
+                league.update(_unwrap_league(record["body"]))
+        if not league:
+            raise MissingPayloadError(
+                f'No stored response to "{url}" for {self.platform} season "{self.season_id}"'
+            )
+        return league
+
     def get_season(self, key_map=None):
         """
         Request a season from ESPN
@@ -43,28 +212,97 @@ class ESPNSeason:
             parsed from the API response
         :return: A DataFrame representing the season
         """
-        self.response = League(
-            league_id=self.league_id,
-            year=self.year,
-            espn_s2=self.s2,
-            swid=self.swid,
-        )
-        response = vars(self.response)
-        response["settings"] = vars(response["settings"])
+        league = self.fetch_league()
+        status = league["status"]
+        settings = vars(BaseSettings(league["settings"]))
+        teams = self._parse_teams(league)
+        response = {
+            "league_id": self.league_id,
+            "year": self.year,
+            "currentMatchupPeriod": status["currentMatchupPeriod"],
+            "scoringPeriodId": league["scoringPeriodId"],
+            "firstScoringPeriod": status["firstScoringPeriod"],
+            "nfl_week": status.get("latestScoringPeriod"),
+            "settings": settings,
+        }
         self.start_week = response.get("firstScoringPeriod", 1)
-        self.regular_season_weeks = response["settings"].get(
-            "reg_season_count"
-        )
-        self.team_objs = [vars(team) for team in response["teams"]]
-        self.draft_picks = [vars(pick) for pick in response["draft"]]
-        self.player_map = response["player_map"]
+        self.regular_season_weeks = settings.get("reg_season_count")
+        self.team_objs = [vars(team) for team in teams]
+        self.rosters = [player for team in teams for player in team.roster]
+        self.draft_picks = [
+            vars(pick) for pick in self._parse_draft(league, teams)
+        ]
         if key_map:
-            response = format_response(response, key_map)
-        self.season = pd.DataFrame([response])
+            response = format_columns(response, key_map)
+        else:
+            response = [response]
+        self.season = to_dataframe(response)
         self.season["season_id"] = self.season_id
         self.season["league_name"] = self.league_name
         return self.season
 
+    @staticmethod
+    def _parse_teams(league):
+        """
+        Build the teams of a league as espn_api's League does, with the
+            opponents of their schedule kept as team IDs
+
+        :param league: The league of the API response
+        :return: A list of espn_api Team objects, sorted by team ID
+        """
+        members = {member["id"]: member for member in league["members"]}
+        teams = list()
+        for team in league["teams"]:
+            # The teams of a league that isn't full have no owner
+            owners = team.get("owners") or [None]
+            teams.append(
+                Team(
+                    team,
+                    roster=team["roster"],
+                    member=members.get(owners[0]),
+                    schedule=league["schedule"],
+                    year=league["seasonId"],
+                )
+            )
+        teams.sort(key=lambda team: team.team_id)
+        scores = {team.team_id: team.scores for team in teams}
+        for team in teams:
+            team.mov = [
+                score - scores[opponent_id][week]
+                for week, (score, opponent_id) in enumerate(
+                    zip(team.scores, team.schedule)
+                )
+            ]
+        return teams
+
+    def _parse_draft(self, league, teams):
+        """
+        Build the picks of a league's draft as espn_api's League does,
+            with the names of the players left to get_draft_picks
+
+        :param league: The league of the API response
+        :param teams: The list of espn_api Team objects of the league
+        :return: A list of espn_api Pick objects, empty if the league
+            has not drafted
+        """
+        draft_detail = league.get("draftDetail", dict())
+        if not draft_detail.get("drafted"):
+            return list()
+        teams = {team.team_id: team for team in teams}
+        return [
+            Pick(
+                teams.get(pick["teamId"]),
+                pick["playerId"],
+                "",
+                pick["roundId"],
+                pick["roundPickNumber"],
+                pick["bidAmount"],
+                pick["keeper"],
+                teams.get(pick["nominatingTeamId"]),
+            )
+            for pick in draft_detail["picks"]
+        ]
+
     def get_draft_picks(self, key_map=None):
         """
         Parse the draft picks for the season
@@ -73,17 +311,116 @@ class ESPNSeason:
             parsed from the raw draft picks data
         :return: A DataFrame representing the draft picks
         """
+        players = self.get_players(
+            pick["playerId"] for pick in self.draft_picks
+        )
         for pick in self.draft_picks:
             pick["team"] = vars(pick["team"])
+            player = players.get(pick["playerId"], dict())
+            pick["playerName"] = player.get("name") or pick["playerName"]
+            pick["position"] = player.get("position")
         if key_map:
-            self.draft_picks = format_response(self.draft_picks, key_map)
-        self.draft_picks = pd.DataFrame(self.draft_picks)
-        self.draft_picks["position"] = self.draft_picks["player_id"].apply(
-            lambda x: self.response.player_info(playerId=x).position
-        )
+            self.draft_picks = format_columns(self.draft_picks, key_map)
+        self.draft_picks = to_dataframe(self.draft_picks)
         self.draft_picks["season_id"] = self.season_id
         return self.draft_picks
 
+    def get_players(self, player_ids):
+        """
+        Look up the names and positions of players on the rosters of
+            this season's teams, then among the players seen in any
+            earlier season, and finally with a single request to ESPN
+            for all the players that are left
+
+        :param player_ids: An iterable of ESPN player IDs
+        :return: A dictionary of player IDs to dictionaries with the
+            keys name and position
+        """
+        player_ids = {
+            int(player_id) for player_id in player_ids if pd.notna(player_id)
+        }
+        self._store_players(self.rosters)
+        with self._players_lock:
+            missing_ids = sorted(player_ids - self.players.keys())
+        if missing_ids:
+            self._store_players(self._request_players(missing_ids))
+            with self._players_lock:
+                # Don't ask again for players ESPN has no card for
+                for player_id in missing_ids:
+                    self.players.setdefault(
+                        player_id, {"name": None, "position": None}
+                    )
+        with self._players_lock:
+            return {
+                player_id: self.players[player_id] for player_id in player_ids
+            }
+
+    def _request_players(self, player_ids):
+        """
+        Request the player cards of several players from ESPN at once
+
+        :param player_ids: A list of ESPN player IDs
+        :return: A list of espn_api Player objects
+        """
+        filters = {
+            "players": {
+                "filterIds": {"value": player_ids},
+                "limit": len(player_ids),
+            }
+        }
+        try:
+            data = self.client.get_json(
+                self._league_url(view="kona_playercard"),
+                platform=self.platform,
+                ttl=PERMANENT,
+                headers={"x-fantasy-filter": json.dumps(filters)},
+                cookies=self.cookies,
+            )
+        except MissingPayloadError:
+            # The players requested depend on the seasons extracted
+            # before this one, so a replay looks them up among the
+            # players requested by any season instead
+            return self._replay_players(player_ids)
+        return [
+            Player(player, self.year)
+            for player in _unwrap_league(data)["players"]
+        ]
+
+    def _replay_players(self, player_ids):
+        """
+        Find the player cards of several players among every response
+            to a kona_playercard request stored in the landing zone
+
+        :param player_ids: A list of ESPN player IDs
+        :return: A list of espn_api Player objects
+        """
+        player_ids = set(player_ids)
+        players = dict()
+        for record in self.payloads.landing_zone.read_platform(self.platform):
+            if "kona_playercard" not in record["url"]:
+                continue
+            for data in _unwrap_league(record["body"])["players"]:
+                player = Player(data, self.year)
+                if player.playerId in player_ids:
+                    players[player.playerId] = player
+        return list(players.values())
+
+    @classmethod
+    def _store_players(cls, players):
+        """
+        Add the names and positions of players to the players shared by
+            every season
+
+        :param players: An iterable of espn_api Player objects
+        :return: None
+        """
+        with cls._players_lock:
+            for player in players:
+                cls.players[player.playerId] = {
+                    "name": player.name,
+                    "position": getattr(player, "position", None),
+                }
+
     def get_teams(self, key_map=None):
         """
         Parse the teams for the season
@@ -93,25 +430,87 @@ class ESPNSeason:
         :return: A DataFrame representing the teams
         """
         if key_map:
-            self.teams = format_response(self.team_objs, key_map)
-        self.teams = pd.DataFrame(self.teams)
+            self.teams = format_columns(self.team_objs, key_map)
+        self.teams = to_dataframe(self.teams)
         self.teams["season_id"] = self.season_id
         return self.teams
 
     def get_matchups(self, key_map=None):
         """
-        Parse the matchups for the season
+        Parse the matchups for the season into one row per team per
+            week. The team attributes holding a list with a value per
+            week (e.g. schedule, scores, mov) are spread over the weeks,
+            and the other attributes are repeated for every week.
 
+        :param key_map: A dictionary representing the values to be
+            parsed from the raw teams data, or its plan from
+            compile_key_map
         :return: A DataFrame representing the matchups
         """
+        if key_map is None:
+            plan = tuple(
+                ((key,), key, None)
+                for key in ("team_id", "schedule", "scores", "mov", "week")
+            )
+        elif isinstance(key_map, tuple):
+            plan = key_map
+        else:
+            plan = compile_key_map(key_map)
+        keys = [path[0] for path, _, _ in plan]
+        columns = {key: list() for key in keys}
         for team in self.team_objs:
-            team["schedule"] = [
-                opponent.team_id for opponent in team["schedule"]
-            ]
-            team["week"] = [i + 1 for i in range(len(team["schedule"]))]
-        matchups = format_response(self.team_objs, key_map)
-        matchups = pd.DataFrame(matchups)
-        matchups = matchups.apply(pd.Series.explode)
+            weeks_count = len(team["schedule"])
+            for key in keys:
+                if key == "week":
+                    values = range(1, weeks_count + 1)
+                elif key == "schedule":
+                    # espn_api replaces the opponents' IDs with their Team
+                    values = [
+                        getattr(opponent, "team_id", opponent)
+                        for opponent in team["schedule"]
+                    ]
+                elif isinstance(team.get(key), list):
+                    values = team[key][:weeks_count]
+                    values += [None] * (weeks_count - len(values))
+                else:
+                    values = [team.get(key)] * weeks_count
+                columns[key].extend(values)
+        matchups = to_dataframe(
+            {
+                col_name: _typed_column(columns[path[0]], data_type)
+                for path, col_name, data_type in plan
+            }
+        )
         matchups["season_id"] = self.season_id
         self.matchups = matchups
         return self.matchups
+
+
+def _unwrap_league(response):
+    """
+    Unwrap the league of a response to a request for a league. ESPN
+        answers the requests for the seasons before 2018, made to the
+        league's history, with a list holding the league.
+
+    :param response: The JSON body of the response
+    :return: The league of the response
+    """
+    if isinstance(response, list):
+        return response[0]
+    return response
+
+
+def _typed_column(values, data_type):
+    """
+    Build a column of matchups with the dtype of its data type, falling
+        back to an object column when the values don't fit it
+
+    :param values: A list of values
+    :param data_type: A BigQuery data type, or None
+    :return: A pandas.Series
+    """
+    dtype = PANDAS_DTYPES.get(data_type)
+    try:
+        return pd.Series(values, dtype=dtype)
+    except (TypeError, ValueError):
+        return pd.Series(values, dtype=object)
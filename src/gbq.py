@@ -0,0 +1,427 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fsspec
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+from src.metrics import get_default_metrics, span, Span
+from src.storage import compact_parquet, find_files, read_text, write_text
+
+FINGERPRINT_LABEL = "source_fingerprint"
+# The file a compacted table's directory keeps the fingerprint of the
+# files it was compacted from in
+COMPACTED_FINGERPRINT_FILE = "_source_fingerprint"
+
+
+def source_fingerprint(uris, schema):
+    """
+    Fingerprint the parquet files matched by BigQuery wildcard URIs
+        together with the schema they are loaded with
+
+    :param uris: A list of URIs ending in a wildcard, e.g.
+        gs://bucket/table/league/*.parquet
+    :param schema: A dictionary of column names to BigQuery data types
+    :return: A tuple of a hex digest that changes whenever a matched
+        file is added, removed or rewritten, or the schema changes (None
+        if no file matches); and the list of the URIs matching any file
+    """
+    files = list()
+    matched_uris = list()
+    for uri in uris:
+        prefix, suffix = uri.split("*", 1)
+        fs, fs_prefix = fsspec.core.url_to_fs(prefix)
+        uri_files = [
+            (name, info.get("size"), _version(info))
+            for name, info in fs.find(fs_prefix, detail=True).items()
+            if name.endswith(suffix)
+        ]
+        if uri_files:
+            files.extend(uri_files)
+            matched_uris.append(uri)
+    if not files:
+        return None, matched_uris
+    digest = hashlib.sha1(json.dumps([sorted(files), schema]).encode())
+    return digest.hexdigest(), matched_uris
+
+
+def _version(info):
+    """
+    Get whatever identifies the version of a file in a filesystem
+        listing
+
+    :param info: The details of a file from fsspec's find
+    :return: A JSON-serializable value
+    """
+    for key in ("md5Hash", "generation", "etag", "mtime", "updated"):
+        if info.get(key) is not None:
+            return str(info[key])
+    return None
+
+
+class TableCompactor:
+    def __init__(self, storage_root, logger, max_workers=1, **options):
+        """
+        Initialize the TableCompactor class, which merges the small
+            parquet files a BigQuery load would read (one per season,
+            or per season and week) into a few large files under
+            _compacted in the storage root
+
+        :param storage_root: The root the tables are stored under, as
+            returned by storage_root
+        :param logger: A logging.Logger
+        :param max_workers: The maximum number of tables compacted at
+            once
+        :param options: The keyword arguments of compact_parquet the
+            files are written with (compression, row_group_size, ...)
+        """
+        self.storage_root = storage_root
+        self.logger = logger
+        self.max_workers = max_workers
+        self.options = options
+
+    def compact(self, loads, name):
+        """
+        Compact the files of several BigQuery loads at once
+
+        :param loads: A list of load dictionaries, as taken by
+            TableLoader.load
+        :param name: The directory the compacted files of each table
+            are kept in under the table's, naming what the loads cover:
+            a league, or the leagues of a batch
+        :return: The list of the loads of the compacted files, in the
+            same order
+        """
+        if not loads:
+            return loads
+        with ThreadPoolExecutor(
+            max_workers=max(min(self.max_workers, len(loads)), 1)
+        ) as executor:
+            return list(
+                executor.map(
+                    lambda load: self.compact_table(load, name), loads
+                )
+            )
+
+    def compact_table(self, load, name):
+        """
+        Merge the files of a BigQuery load into a few large files under
+            _compacted/<table>/<name>, plus the partition for the load
+            of a single partition. The files are only compacted again
+            when the files they were compacted from, their schema or
+            the options have changed since, so that the load of an
+            unchanged table is still skipped.
+
+        :param load: A load dictionary, as taken by TableLoader.load
+        :param name: The directory the compacted files are kept in
+            under the table's (see compact)
+        :return: The load dictionary reading the compacted files, or
+            the load unchanged if it matches no file or the compaction
+            failed
+        """
+        table_name, _, partition = (
+            load["table_id"].rsplit(".", 1)[-1].partition("$")
+        )
+        path = f"{self.storage_root}/_compacted/{table_name}/{name}"
+        if partition:
+            path = f"{path}/{partition}"
+        fingerprint, uris = source_fingerprint(
+            load["uris"], [load["schema"], self.options]
+        )
+        if fingerprint is None:
+            return load
+        compacted_load = {**load, "uris": [f"{path}/*.parquet"]}
+        fingerprint_path = f"{path}/{COMPACTED_FINGERPRINT_FILE}"
+        if read_text(fingerprint_path) == fingerprint:
+            self.logger.info(f"Unchanged, skipped compacting {path}")
+            return compacted_load
+        source_files = [
+            source_file for uri in uris for source_file in find_files(uri)
+        ]
+        try:
+            with span("compact_table", table=table_name):
+                compact_parquet(
+                    source_files, path, load["schema"], **self.options
+                )
+                write_text(fingerprint_path, fingerprint)
+        except Exception:
+            self.logger.exception(
+                f'Failed to compact "{", ".join(uris)}", loading them as they are'
+            )
+            return load
+        self.logger.info(f"Compacted {len(source_files)} file(s) to {path}")
+        return compacted_load
+
+
+class TableLoader:
+    def __init__(self, gbq_client, logger, max_workers=8, metrics=None):
+        """
+        Initialize the TableLoader class, which loads parquet files
+            from GCS into BigQuery tables
+
+        :param gbq_client: A bigquery.Client, or a stand-in with the
+            same load_table_from_uri, get_table, update_table,
+            create_table and delete_table methods
+        :param logger: A logging.Logger
+        :param max_workers: The maximum number of load jobs to wait on
+            at once
+        :param metrics: The Metrics to record a bigquery_load span per
+            job in. Defaults to the metrics of the whole process.
+        """
+        self.gbq_client = gbq_client
+        self.logger = logger
+        self.max_workers = max_workers
+        self.metrics = metrics or get_default_metrics()
+        self._labels_lock = threading.Lock()
+
+    def load(self, loads):
+        """
+        Submit a load job for every table (or partition) whose source
+            files changed since its last successful load, then wait for
+            all of them together. Each table (or partition) is truncated
+            and reloaded.
+
+        :param loads: A list of dictionaries with the keys uris (a list
+            of wildcard URIs, e.g. one per league), table_id and schema
+            (column names to BigQuery data types). The URIs matching no
+            file are left out of the load. To replace a single partition
+            of a table partitioned by integer range, the table_id ends
+            with a $ partition decorator (e.g. project.dataset.table$2020)
+            and the load also has the keys range_partitioning (a
+            dictionary with the keys field, start, end and interval) and
+            clustering_fields (a list of column names), which the table
+            is created with if needed.
+        :return: A list of dictionaries summarizing each load, with the
+            keys table_id, status (loaded, skipped or failed), rows and
+            seconds
+        """
+        submitted = list()
+        summary = list()
+        prepared_tables = set()
+        for load in loads:
+            table_id = _split_table_id(load["table_id"])[0]
+            if load.get("range_partitioning") and (
+                table_id not in prepared_tables
+            ):
+                # Before reading the fingerprints, which are lost if the
+                # table has to be recreated
+                self._prepare_partitioned_table(table_id, load)
+                prepared_tables.add(table_id)
+            fingerprint, uris = source_fingerprint(
+                load["uris"], load["schema"]
+            )
+            if fingerprint is None:
+                self.logger.warning(
+                    f'No files found at "{", ".join(load["uris"])}"'
+                )
+                summary.append(_summary(load, "skipped"))
+                continue
+            if fingerprint == self._stored_fingerprint(load["table_id"]):
+                self.logger.info(
+                    f'Skipped table "{load["table_id"]}" (source unchanged)'
+                )
+                summary.append(_summary(load, "skipped"))
+                continue
+            job_config = bigquery.LoadJobConfig(
+                schema=_schema_fields(load["schema"]),
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                source_format=bigquery.SourceFormat.PARQUET,
+            )
+            if load.get("range_partitioning"):
+                job_config.range_partitioning = _range_partitioning(
+                    load["range_partitioning"]
+                )
+                job_config.clustering_fields = load.get("clustering_fields")
+            load_job = self.gbq_client.load_table_from_uri(
+                uris, load["table_id"], job_config=job_config
+            )
+            submitted.append(
+                (
+                    {**load, "uris": uris},
+                    fingerprint,
+                    load_job,
+                    time.monotonic(),
+                )
+            )
+        if submitted:
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(submitted))
+            ) as executor:
+                summary.extend(executor.map(self._wait, submitted))
+        self._log_summary(summary)
+        return summary
+
+    def _wait(self, submitted_load):
+        """
+        Wait for a load job and record the fingerprint of what it
+            loaded
+
+        :param submitted_load: A tuple of the load dictionary, source
+            fingerprint, load job, and the time it was submitted
+        :return: A dictionary summarizing the load
+        """
+        load, fingerprint, load_job, submitted_at = submitted_load
+        span = Span("bigquery_load", {"table_id": load["table_id"]})
+        try:
+            load_job.result()  # Waits for the job to complete.
+        except Exception:
+            self.logger.exception(
+                f'Failed to load data from location "{", ".join(load["uris"])}" to table "{load["table_id"]}"'
+            )
+            span.errors += 1
+            seconds = time.monotonic() - submitted_at
+            self.metrics.record(span, seconds)
+            return _summary(load, "failed", seconds=seconds)
+        seconds = time.monotonic() - submitted_at
+        span.add(rows=getattr(load_job, "output_rows", None) or 0)
+        self.metrics.record(span, seconds)
+        self._store_fingerprint(load["table_id"], fingerprint)
+        self.logger.info(
+            f'Loaded data from location "{", ".join(load["uris"])}" to table "{load["table_id"]}"'
+        )
+        return _summary(
+            load,
+            "loaded",
+            rows=getattr(load_job, "output_rows", None),
+            seconds=seconds,
+        )
+
+    def _prepare_partitioned_table(self, table_id, load):
+        """
+        Create a table partitioned by integer range and clustered as a
+            load describes, unless it already exists that way. A table
+            partitioned otherwise (or not at all) is dropped first, so
+            every partition is then loaded again.
+
+        :param table_id: The fully qualified ID of the table, without a
+            partition decorator
+        :param load: A load dictionary passed to load
+        :return: None
+        """
+        range_partitioning = _range_partitioning(load["range_partitioning"])
+        clustering_fields = load.get("clustering_fields")
+        try:
+            table = self.gbq_client.get_table(table_id)
+        except NotFound:
+            table = None
+        if table is not None:
+            if (
+                table.range_partitioning == range_partitioning
+                and table.clustering_fields == clustering_fields
+            ):
+                return
+            self.logger.warning(
+                f'Recreating table "{table_id}" partitioned by {range_partitioning.field}'
+            )
+            self.gbq_client.delete_table(table_id)
+        table = bigquery.Table(table_id, schema=_schema_fields(load["schema"]))
+        table.range_partitioning = range_partitioning
+        table.clustering_fields = clustering_fields
+        self.gbq_client.create_table(table, exists_ok=True)
+
+    def _stored_fingerprint(self, table_id):
+        """
+        Get the fingerprint of the source files of a table's (or
+            partition's) last successful load
+
+        :param table_id: The fully qualified ID of the table, with a
+            partition decorator for a partition
+        :return: A hex digest, or None if the table does not exist or
+            was not loaded by a TableLoader
+        """
+        table_id, label = _split_table_id(table_id)
+        try:
+            table = self.gbq_client.get_table(table_id)
+        except NotFound:
+            return None
+        return (table.labels or dict()).get(label)
+
+    def _store_fingerprint(self, table_id, fingerprint):
+        """
+        Label a table with the fingerprint of the source files it (or
+            one of its partitions) was just loaded from
+
+        :param table_id: The fully qualified ID of the table, with a
+            partition decorator for a partition
+        :param fingerprint: The hex digest of the source files
+        :return: None
+        """
+        table_id, label = _split_table_id(table_id)
+        # The partitions of a table are labeled from several threads
+        with self._labels_lock:
+            table = self.gbq_client.get_table(table_id)
+            table.labels = {**(table.labels or dict()), label: fingerprint}
+            self.gbq_client.update_table(table, ["labels"])
+
+    def _log_summary(self, summary):
+        """
+        Log the outcome and timing of every load
+
+        :param summary: The list returned by load
+        :return: None
+        """
+        lines = [f"{'table':<40} {'status':<8} {'rows':>9} {'seconds':>8}"]
+        for item in summary:
+            rows = "" if item["rows"] is None else item["rows"]
+            seconds = (
+                "" if item["seconds"] is None else f"{item['seconds']:.1f}"
+            )
+            lines.append(
+                f"{item['table_id'].rsplit('.', 1)[-1]:<40} {item['status']:<8} {rows:>9} {seconds:>8}"
+            )
+        self.logger.info("BigQuery load summary:\n" + "\n".join(lines))
+
+
+def _split_table_id(table_id):
+    """
+    Split a partition decorator off a table ID
+
+    :param table_id: A fully qualified table ID, e.g.
+        project.dataset.table or project.dataset.table$2020
+    :return: A tuple of the table ID without the decorator, and the
+        label the fingerprint of the table or partition is stored under
+    """
+    table_id, _, partition = table_id.partition("$")
+    if not partition:
+        return table_id, FINGERPRINT_LABEL
+    return table_id, f"{FINGERPRINT_LABEL}_{partition}"
+
+
+def _schema_fields(schema):
+    return [
+        bigquery.SchemaField(col_name, data_type)
+        for col_name, data_type in schema.items()
+    ]
+
+
+def _range_partitioning(range_partitioning):
+    return bigquery.RangePartitioning(
+        field=range_partitioning["field"],
+        range_=bigquery.PartitionRange(
+            start=range_partitioning["start"],
+            end=range_partitioning["end"],
+            interval=range_partitioning["interval"],
+        ),
+    )
+
+
+def _summary(load, status, rows=None, seconds=None):
+    """
+    Summarize the outcome of one load
+
+    :param load: A load dictionary passed to TableLoader.load
+    :param status: loaded, skipped or failed
+    :param rows: The number of rows loaded
+    :param seconds: The number of seconds from submitting the job to
+        its completion
+    :return: A dictionary
+    """
+    return {
+        "table_id": load["table_id"],
+        "status": status,
+        "rows": rows,
+        "seconds": seconds,
+    }
@@ -0,0 +1,341 @@
+import datetime
+import gzip
+import json
+import re
+import threading
+
+import fsspec
+
+from src.client import endpoint
+
+
+class MissingPayloadError(LookupError):
+    """Raised when a replayed request has no stored response"""
+
+
+class LandingZone:
+    def __init__(self, path):
+        """
+        Initialize the LandingZone class, the store of every raw API
+            response received for a league: one gzipped NDJSON file
+            per platform, season and endpoint, with a line per request
+
+        :param path: The local directory or fsspec URL (e.g.
+            gs://bucket/_raw/league) to keep the responses in
+        """
+        self.fs, self.path = fsspec.core.url_to_fs(path)
+        self._lock = threading.Lock()
+
+    def recorder(self, platform, season_id):
+        """
+        Get an object recording the responses of a season's requests
+
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        :return: A SeasonRecorder
+        """
+        return SeasonRecorder(self, platform, season_id)
+
+    def replayer(self, platform, season_id):
+        """
+        Get an object serving a season's requests from the stored
+            responses
+
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        :return: A SeasonReplayer
+        """
+        return SeasonReplayer(self, platform, season_id)
+
+    def has_season(self, platform, season_id):
+        """
+        Check whether any response is stored for a season
+
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        :return: A boolean
+        """
+        return self.fs.exists(self._season_path(platform, season_id))
+
+    def read(self, platform, season_id):
+        """
+        Read every stored response of a season
+
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        :return: A list of dictionaries with the keys url, filter,
+            fetched_at and body
+        """
+        season_path = self._season_path(platform, season_id)
+        if not self.fs.exists(season_path):
+            return list()
+        records = list()
+        for file_path in sorted(self.fs.find(season_path)):
+            if file_path.endswith(".ndjson.gz"):
+                records.extend(self._read_file(file_path))
+        return records
+
+    def read_platform(self, platform):
+        """
+        Read every stored response of every season of a platform
+
+        :param platform: sleeper or espn
+        :return: A list of dictionaries, as returned by read
+        """
+        platform_path = f"{self.path}/{platform}"
+        if not self.fs.exists(platform_path):
+            return list()
+        records = list()
+        for season_path in sorted(self.fs.ls(platform_path, detail=False)):
+            season_id = season_path.rstrip("/").rsplit("/", 1)[-1]
+            records.extend(self.read(platform, season_id))
+        return records
+
+    def write(self, platform, season_id, records):
+        """
+        Store responses of a season, replacing the stored responses to
+            the same requests and keeping the others (e.g. the weeks not
+            requested again by an incremental run)
+
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        :param records: A list of dictionaries with the keys url,
+            filter, fetched_at and body
+        :return: None
+        """
+        files = dict()
+        for record in records:
+            files.setdefault(_file_name(record["url"]), list()).append(record)
+        season_path = self._season_path(platform, season_id)
+        with self._lock:
+            self.fs.makedirs(season_path, exist_ok=True)
+            for file_name, file_records in files.items():
+                file_path = f"{season_path}/{file_name}"
+                merged = {
+                    _record_key(record): record
+                    for record in self._read_file(file_path)
+                }
+                merged.update(
+                    (_record_key(record), record) for record in file_records
+                )
+                lines = [
+                    json.dumps(merged[key], separators=(",", ":"))
+                    for key in sorted(merged)
+                ]
+                with self.fs.open(file_path, "wb") as f:
+                    f.write(gzip.compress("\n".join(lines).encode() + b"\n"))
+
+    def _read_file(self, file_path):
+        """
+        Read the responses stored in one file
+
+        :param file_path: A path within the landing zone's filesystem
+        :return: A list of dictionaries, empty if the file is missing
+        """
+        try:
+            with self.fs.open(file_path, "rb") as f:
+                text = gzip.decompress(f.read()).decode()
+        except FileNotFoundError:
+            return list()
+        return [json.loads(line) for line in text.splitlines() if line]
+
+    def _season_path(self, platform, season_id):
+        return f"{self.path}/{platform}/{season_id}"
+
+
+class SeasonRecorder:
+    def __init__(self, landing_zone, platform, season_id):
+        """
+        Initialize the SeasonRecorder class, which keeps the responses
+            of a season's requests until they are flushed to the
+            landing zone
+
+        :param landing_zone: A LandingZone
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        """
+        self.landing_zone = landing_zone
+        self.platform = platform
+        self.season_id = season_id
+        self.replaying = False
+        self.records = list()
+        self._lock = threading.Lock()
+
+    def fetch(self, url, request, fantasy_filter=None):
+        """
+        Make a request and record its response
+
+        :param url: The URL of the request, with its query string
+        :param request: A function taking no arguments that makes the
+            request and returns the parsed body of its response
+        :param fantasy_filter: The x-fantasy-filter header of an ESPN
+            request
+        :return: The parsed body of the response
+        """
+        body = request()
+        self.add(url, body, fantasy_filter=fantasy_filter)
+        return body
+
+    def fetch_many(self, urls, request):
+        """
+        Make several requests at once and record their responses
+
+        :param urls: The URLs of the requests
+        :param request: A function taking no arguments that makes the
+            requests and returns the parsed bodies of their responses,
+            in the same order as urls
+        :return: A list of the parsed bodies
+        """
+        bodies = request()
+        for url, body in zip(urls, bodies):
+            self.add(url, body)
+        return bodies
+
+    def add(self, url, body, fantasy_filter=None):
+        """
+        Record the response to a request
+
+        :param url: The URL of the request, with its query string
+        :param body: The parsed body of the response
+        :param fantasy_filter: The x-fantasy-filter header of an ESPN
+            request
+        :return: None
+        """
+        with self._lock:
+            self.records.append(
+                {
+                    "url": url,
+                    "filter": fantasy_filter,
+                    "fetched_at": _now(),
+                    "body": body,
+                }
+            )
+
+    def flush(self):
+        """
+        Write the recorded responses to the landing zone
+
+        :return: None
+        """
+        with self._lock:
+            records, self.records = self.records, list()
+        if records:
+            self.landing_zone.write(self.platform, self.season_id, records)
+
+
+class SeasonReplayer:
+    def __init__(self, landing_zone, platform, season_id):
+        """
+        Initialize the SeasonReplayer class, which answers a season's
+            requests with the responses stored in the landing zone,
+            without any network access
+
+        :param landing_zone: A LandingZone
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        """
+        self.landing_zone = landing_zone
+        self.platform = platform
+        self.season_id = season_id
+        self.replaying = True
+        self._bodies = None
+        self._lock = threading.Lock()
+
+    def fetch(self, url, request=None, fantasy_filter=None):
+        """
+        Get the stored response to a request
+
+        :param url: The URL of the request, with its query string
+        :param request: Ignored; the request is never made
+        :param fantasy_filter: The x-fantasy-filter header of an ESPN
+            request
+        :return: The parsed body of the stored response
+        :raises MissingPayloadError: If no response is stored
+        """
+        with self._lock:
+            if self._bodies is None:
+                self._bodies = {
+                    _record_key(record): record["body"]
+                    for record in self.landing_zone.read(
+                        self.platform, self.season_id
+                    )
+                }
+            key = _record_key({"url": url, "filter": fantasy_filter})
+            if key not in self._bodies:
+                raise MissingPayloadError(
+                    f'No stored response to "{url}" for {self.platform} season "{self.season_id}"'
+                )
+            return self._bodies[key]
+
+    def fetch_many(self, urls, request=None):
+        """
+        Get the stored responses to several requests
+
+        :param urls: The URLs of the requests
+        :param request: Ignored; the requests are never made
+        :return: A list of the parsed bodies, in the same order as urls
+        """
+        return [self.fetch(url) for url in urls]
+
+    def flush(self):
+        pass
+
+
+class PayloadClient:
+    def __init__(self, client, payloads):
+        """
+        Initialize the PayloadClient class, which makes the requests of
+            a season through a SeasonRecorder or SeasonReplayer. It has
+            the methods of HttpClient the seasons use.
+
+        :param client: The HttpClient to make the requests with
+        :param payloads: A SeasonRecorder or SeasonReplayer
+        """
+        self.client = client
+        self.payloads = payloads
+
+    def get_json(
+        self, url, platform=None, ttl=None, headers=None, cookies=None
+    ):
+        return self.payloads.fetch(
+            url,
+            lambda: self.client.get_json(
+                url,
+                platform=platform,
+                ttl=ttl,
+                headers=headers,
+                cookies=cookies,
+            ),
+            fantasy_filter=(headers or dict()).get("x-fantasy-filter"),
+        )
+
+    def get_json_many(self, urls, platform=None, concurrency=1, ttl=None):
+        return self.payloads.fetch_many(
+            urls,
+            lambda: self.client.get_json_many(
+                urls, platform=platform, concurrency=concurrency, ttl=ttl
+            ),
+        )
+
+    def persist(self, url):
+        if not self.payloads.replaying:
+            self.client.persist(url)
+
+
+def _file_name(url):
+    """
+    Get the name of the file the responses of an endpoint are stored in
+
+    :param url: The URL of a request
+    :return: A string, e.g. v1_league_matchups.ndjson.gz
+    """
+    name = re.sub(r"[^0-9A-Za-z]+", "_", endpoint(url).replace("{id}", ""))
+    return f"{name.strip('_') or 'root'}.ndjson.gz"
+
+
+def _record_key(record):
+    return f"{record['url']}\n{record.get('filter') or ''}"
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
@@ -0,0 +1,194 @@
+import datetime
+import hashlib
+import json
+import threading
+import uuid
+
+import fsspec
+import pandas as pd
+
+
+def row_hashes(df):
+    """
+    Hash every row of a DataFrame, ignoring its index
+
+    :param df: A pandas.DataFrame
+    :return: A numpy array of uint64 hashes, one per row
+    """
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def content_hash(columns, hashes, schema=None):
+    """
+    Hash the content of a table from its column names and row hashes
+
+    :param columns: The column names of the table, in order
+    :param hashes: The row hashes of the table, as returned by
+        row_hashes
+    :param schema: The dictionary of column names to BigQuery data
+        types the table is written with, so that the hash changes when
+        the schema does
+    :return: A hex digest
+    """
+    digest = hashlib.sha1(json.dumps([list(columns), schema]).encode())
+    digest.update(hashes.tobytes())
+    return digest.hexdigest()
+
+
+def partitions_hash(partitions):
+    """
+    Hash the content of a partitioned table from its partitions
+
+    :param partitions: A dictionary of partition names to dictionaries
+        with the key content_hash
+    :return: A hex digest
+    """
+    digest = hashlib.sha1()
+    for name in sorted(partitions):
+        digest.update(f"{name}={partitions[name]['content_hash']};".encode())
+    return digest.hexdigest()
+
+
+class LoadManifest:
+    def __init__(self, path):
+        """
+        Initialize the LoadManifest class, a single JSON object per
+            league recording every season extracted to GCS: the tables
+            written, their row counts and content hashes, and when
+
+        :param path: The local path or fsspec URL (e.g.
+            gs://bucket/_manifests/league.json) of the manifest
+        """
+        self.path = path
+        self.fs, self.fs_path = fsspec.core.url_to_fs(path)
+        self.exists = False
+        self.seasons = dict()
+        self._lock = threading.Lock()
+
+    def read(self):
+        """
+        Read the manifest, replacing whatever was read before
+
+        :return: self
+        """
+        try:
+            with self.fs.open(self.fs_path, "r") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = None
+        with self._lock:
+            self.exists = manifest is not None
+            self.seasons = (manifest or dict()).get("seasons", dict())
+        return self
+
+    def get_season(self, platform, season_id):
+        """
+        Get the record of a loaded season
+
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        :return: A dictionary with the keys platform, season_id, year,
+            last_completed_week, is_complete, loaded_at, partitioned and
+            tables; or
+            None if the season has not been loaded
+        """
+        with self._lock:
+            return self.seasons.get(_season_key(platform, season_id))
+
+    def get_seasons(self, platform):
+        """
+        Get the records of every loaded season of a platform
+
+        :param platform: sleeper or espn
+        :return: A list of dictionaries, as returned by get_season
+        """
+        with self._lock:
+            return [
+                record
+                for record in self.seasons.values()
+                if record["platform"] == platform
+            ]
+
+    def is_loaded(self, platform, season_id, partitioned=False):
+        """
+        Check whether a season was completely extracted
+
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        :param partitioned: Whether the season's tables must have been
+            written for BigQuery tables partitioned by year. A season
+            written the other way is not loaded.
+        :return: A boolean
+        """
+        record = self.get_season(platform, season_id)
+        if record is None:
+            return False
+        return record.get("partitioned", False) == partitioned
+
+    def record_season(self, season_obj, tables, partitioned=False):
+        """
+        Record a season that was just extracted and write the manifest
+
+        :param season_obj: A SleeperSeason or ESPNSeason
+        :param tables: A dictionary of table names to dictionaries with
+            the keys path, rows and content_hash, and partitions for a
+            partitioned table
+        :param partitioned: Whether the tables were written for BigQuery
+            tables partitioned by year
+        :return: None
+        """
+        record = {
+            "platform": season_obj.platform,
+            "season_id": str(season_obj.season_id),
+            "year": season_obj.year,
+            "last_completed_week": getattr(
+                season_obj, "last_completed_week", None
+            ),
+            "is_complete": getattr(season_obj, "is_complete", True),
+            "loaded_at": _now(),
+            "partitioned": partitioned,
+            "tables": tables,
+        }
+        with self._lock:
+            self.seasons[
+                _season_key(season_obj.platform, season_obj.season_id)
+            ] = record
+            self._write()
+
+    def remove_season(self, platform, season_id):
+        """
+        Forget a season, e.g. after its extraction failed, and write the
+            manifest
+
+        :param platform: sleeper or espn
+        :param season_id: The ID of the season
+        :return: None
+        """
+        with self._lock:
+            if self.seasons.pop(_season_key(platform, season_id), None):
+                self._write()
+
+    def _write(self):
+        """
+        Write the manifest atomically: to a temporary object first,
+            which is then moved over the manifest. Must be called while
+            holding the lock.
+
+        :return: None
+        """
+        manifest = {"updated_at": _now(), "seasons": self.seasons}
+        directory = self.fs_path.rsplit("/", 1)[0]
+        self.fs.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.fs_path}.{uuid.uuid4().hex}.tmp"
+        with self.fs.open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        self.fs.mv(tmp_path, self.fs_path)
+        self.exists = True
+
+
+def _season_key(platform, season_id):
+    return f"{platform}/{season_id}"
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
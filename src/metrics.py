@@ -0,0 +1,213 @@
+import contextlib
+import contextvars
+import json
+import threading
+import time
+
+import fsspec
+
+# The counters every span may record
+COUNTERS = ("requests", "cache_hits", "bytes_in", "bytes_out", "rows")
+
+# The prefix of every metric in the OpenMetrics output
+PREFIX = "fantasy_football"
+
+# The labels of the spans open in the current thread or asyncio task,
+# which the spans opened within them inherit
+_open_labels = contextvars.ContextVar("open_labels", default=())
+
+
+class Span:
+    def __init__(self, name, labels):
+        """
+        Initialize the Span class, the measurements of one timed piece
+            of work
+
+        :param name: The name of the work, e.g. fetch or parquet_write
+        :param labels: A dictionary of labels telling it apart from
+            other work of the same name, e.g. the table or endpoint
+        """
+        self.name = name
+        self.labels = labels
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.errors = 0
+
+    def add(self, **counts):
+        """
+        Add to the counters of the span
+
+        :param counts: Amounts to add to any of COUNTERS
+        :return: None
+        """
+        for counter, amount in counts.items():
+            self.counts[counter] += amount
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Initialize the Metrics class, which aggregates the spans of a
+            run by name and labels
+        """
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every span recorded so far
+
+        :return: None
+        """
+        with self._lock:
+            self.started_at = time.time()
+            self.aggregates = dict()
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        """
+        Time the work done within a with block. The span inherits the
+            labels of the spans it is opened within.
+
+        :param name: The name of the work
+        :param labels: Labels telling the work apart from other work of
+            the same name. Labels set to None are left out.
+        :return: A context manager yielding the Span, to add counts to
+        """
+        labels = {
+            **dict(_open_labels.get()),
+            **{k: str(v) for k, v in labels.items() if v is not None},
+        }
+        span = Span(name, labels)
+        token = _open_labels.set(tuple(labels.items()))
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.errors += 1
+            raise
+        finally:
+            _open_labels.reset(token)
+            self.record(span, time.perf_counter() - start)
+
+    def record(self, span, seconds):
+        """
+        Add a finished span to the aggregates
+
+        :param span: A Span
+        :param seconds: The duration of the span
+        :return: None
+        """
+        key = (span.name, tuple(sorted(span.labels.items())))
+        with self._lock:
+            aggregate = self.aggregates.get(key)
+            if aggregate is None:
+                aggregate = {
+                    "name": span.name,
+                    "labels": span.labels,
+                    "count": 0,
+                    "seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "errors": 0,
+                    **dict.fromkeys(COUNTERS, 0),
+                }
+                self.aggregates[key] = aggregate
+            aggregate["count"] += 1
+            aggregate["seconds"] += seconds
+            aggregate["max_seconds"] = max(aggregate["max_seconds"], seconds)
+            aggregate["errors"] += span.errors
+            for counter, amount in span.counts.items():
+                aggregate[counter] += amount
+
+    def to_dict(self):
+        """
+        Summarize the run
+
+        :return: A dictionary with the keys started_at, seconds and
+            spans (a list of aggregates, each with the keys name,
+            labels, count, seconds, max_seconds, errors and COUNTERS)
+        """
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "seconds": time.time() - self.started_at,
+                "spans": [dict(a) for a in self.aggregates.values()],
+            }
+
+    def to_openmetrics(self):
+        """
+        Format the summary of the run in the OpenMetrics text format
+
+        :return: A string
+        """
+        summary = self.to_dict()
+        families = [
+            ("span_seconds", "seconds", "Seconds spent in spans"),
+            ("span_max_seconds", "max_seconds", "Longest span in seconds"),
+            ("spans", "count", "Spans recorded"),
+            ("span_errors", "errors", "Spans that raised an exception"),
+        ] + [(counter, counter, f"{counter} of spans") for counter in COUNTERS]
+        lines = list()
+        for family, field, help_text in families:
+            metric = f"{PREFIX}_{family}"
+            is_gauge = field == "max_seconds"
+            lines.append(
+                f"# TYPE {metric} {'gauge' if is_gauge else 'counter'}"
+            )
+            lines.append(f"# HELP {metric} {help_text}")
+            for aggregate in summary["spans"]:
+                labels = {"span": aggregate["name"], **aggregate["labels"]}
+                label_text = ",".join(
+                    f'{k}="{_escape(v)}"' for k, v in labels.items()
+                )
+                suffix = "" if is_gauge else "_total"
+                lines.append(
+                    f"{metric}{suffix}{{{label_text}}} {aggregate[field]}"
+                )
+        lines.append(f"# TYPE {PREFIX}_run_seconds gauge")
+        lines.append(f"{PREFIX}_run_seconds {summary['seconds']}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write the summary of the run to a file, as JSON if the path ends
+            with .json and in the OpenMetrics text format otherwise
+
+        :param path: A local path or any fsspec URL
+        :return: None
+        """
+        if path.endswith(".json"):
+            text = json.dumps(self.to_dict(), indent=2)
+        else:
+            text = self.to_openmetrics()
+        with fsspec.open(path, "w") as f:
+            f.write(text)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_default_metrics = Metrics()
+
+
+def get_default_metrics():
+    """
+    Get the metrics every span of the process is recorded in
+
+    :return: A Metrics
+    """
+    return _default_metrics
+
+
+def span(name, **labels):
+    """
+    Time the work done within a with block in the default metrics, as
+        described in Metrics.span
+
+    :param name: The name of the work
+    :param labels: Labels telling the work apart from other work of the
+        same name
+    :return: A context manager yielding the Span
+    """
+    return _default_metrics.span(name, **labels)
@@ -1,12 +1,51 @@
+import itertools
+import math
+
+import numpy as np
 import pandas as pd
 
-from src.utils import api_get_request, format_response
+from src.cache import PERMANENT
+from src.client import get_default_client
+from src.landing import PayloadClient
+from src.metrics import span
+from src.utils import (
+    api_get_request,
+    api_get_requests,
+    compile_key_map,
+    format_columns,
+    to_dataframe,
+)
 
 BASE_URL = "https://api.sleeper.app/v1"
 
 
+def get_nfl_state(base_url=BASE_URL, client=None):
+    """
+    Request the current state of the NFL season from the Sleeper API,
+        never from the response cache
+
+    :param base_url: The base URL of the Sleeper API
+    :param client: The HttpClient to make the request with. Defaults to
+        a client shared by the whole process.
+    :return: A dictionary with (among others) the keys season (the
+        year), season_type (pre, regular, post or off) and week (the
+        week in progress)
+    """
+    return api_get_request(
+        f"{base_url}/state/nfl", client=client, platform="sleeper", ttl=0
+    )
+
+
 class SleeperSeason:
-    def __init__(self, season_id, league_name, base_url=BASE_URL):
+    def __init__(
+        self,
+        season_id,
+        league_name,
+        base_url=BASE_URL,
+        concurrency=1,
+        client=None,
+        payloads=None,
+    ):
         """
         Initialize the SleeperSeason class
 
@@ -18,47 +57,132 @@ class SleeperSeason:
         :param league_name: The name of the league to which season_id
             belongs
         :param base_url: The base URL of the Sleeper API
+        :param concurrency: The maximum number of requests in flight at
+            once when requesting one endpoint for many weeks
+        :param client: The HttpClient to make requests with. Defaults
+            to a client shared by the whole process.
+        :param payloads: A SeasonRecorder to record the responses with,
+            or a SeasonReplayer to answer the requests from the landing
+            zone
         """
         self.season_id = season_id
         self.league_name = league_name
         self.platform = "sleeper"
         self.year = None
         self.base_url = base_url
+        self.concurrency = concurrency
+        self.client = client or get_default_client()
+        self.payloads = payloads
+        if payloads is not None:
+            self.client = PayloadClient(self.client, payloads)
+        self.league = None
         self.previous_season_id = None
         self.draft_id = None
         self.start_week = None
         self.playoff_start_week = None
+        self.last_completed_week = None
+        self.is_complete = False
         self.season = None
         self.draft_picks = None
         self.rosters = None
         self.playoff_rounds_count = None
         self.winners_bracket = None
         self.matchups = None
+        self.matchups_responses = dict()
+        self.transactions_responses = dict()
         self.users = None
 
-    def get_season(self, key_map=None):
+    def release(self):
         """
-        Request a season from the Sleeper API
+        Drop the tables and API responses kept by the season once it
+            has been extracted, keeping what identifies it
 
-        :param key_map: A dictionary representing the values to be
-            parsed from the API response
-        :return: A DataFrame representing the season
+        :return: None
         """
+        self.league = None
+        self.season = None
+        self.draft_picks = None
+        self.rosters = None
+        self.winners_bracket = None
+        self.matchups = None
+        self.matchups_responses = dict()
+        self.transactions_responses = dict()
+        self.users = None
+
+    def fetch_league(self):
+        """
+        Request the season's league from the Sleeper API, unless already
+            requested (e.g. while discovering the league's seasons), and
+            keep its year, previous season, draft and weeks
+
+        :return: The API response
+        """
+        if self.league is not None:
+            return self.league
         url = f"{self.base_url}/league/{self.season_id}"
-        response = api_get_request(url)
+        response = api_get_request(
+            url, client=self.client, platform=self.platform
+        )
         self.year = int(response.get("season"))
         self.previous_season_id = response.get("previous_league_id")
         self.draft_id = response.get("draft_id")
         settings = response.get("settings", dict())
         self.start_week = settings.get("start_week")
         self.playoff_start_week = settings.get("playoff_week_start")
+        self.last_completed_week = settings.get("last_scored_leg")
+        self.is_complete = response.get("status") == "complete"
+        self.is_complete |= self._is_final_week_scored(settings)
+        if self.is_complete:
+            # A completed season can never change, so keep it forever
+            self.client.persist(url)
+        self.league = response
+        return self.league
+
+    def get_season(self, key_map=None):
+        """
+        Request a season from the Sleeper API
+
+        :param key_map: A dictionary representing the values to be
+            parsed from the API response
+        :return: A DataFrame representing the season
+        """
+        response = self.fetch_league()
         if key_map:
-            response = format_response(response, key_map)
-        self.season = pd.DataFrame([response])
+            response = format_columns(response, key_map)
+        else:
+            response = [response]
+        self.season = to_dataframe(response)
         self.season["year"] = self.season["year"].astype(int)
         self.season["league_name"] = self.league_name
         return self.season
 
+    @property
+    def cache_ttl(self):
+        """
+        The TTL to cache this season's responses for: forever once the
+            season is complete, otherwise the TTL configured for each
+            endpoint
+        """
+        return PERMANENT if self.is_complete else None
+
+    def _is_final_week_scored(self, settings):
+        """
+        Check whether the final week of the playoffs has been scored
+
+        :param settings: The settings of the season's API response
+        :return: A boolean
+        """
+        playoff_teams = settings.get("playoff_teams")
+        if not (
+            self.last_completed_week
+            and self.playoff_start_week
+            and playoff_teams
+        ):
+            return False
+        playoff_rounds_count = math.ceil(math.log2(playoff_teams))
+        final_week = self.playoff_start_week + playoff_rounds_count - 1
+        return self.last_completed_week >= final_week
+
     def get_draft_picks(self, key_map=None):
         """
         Request the full list of draft picks from a particular draft
@@ -69,10 +193,15 @@ class SleeperSeason:
         :return: A DataFrame representing the draft picks
         """
         url = f"{self.base_url}/draft/{self.draft_id}/picks"
-        response = api_get_request(url)
+        response = api_get_request(
+            url,
+            client=self.client,
+            platform=self.platform,
+            ttl=self.cache_ttl,
+        )
         if key_map:
-            response = format_response(response, key_map)
-        draft_picks = pd.DataFrame(response)
+            response = format_columns(response, key_map)
+        draft_picks = to_dataframe(response)
         draft_picks["season_id"] = self.season_id
         self.draft_picks = draft_picks
         return self.draft_picks
@@ -86,10 +215,15 @@ class SleeperSeason:
         :return: A DataFrame representing the rosters
         """
         url = f"{self.base_url}/league/{self.season_id}/rosters"
-        response = api_get_request(url)
+        response = api_get_request(
+            url,
+            client=self.client,
+            platform=self.platform,
+            ttl=self.cache_ttl,
+        )
         if key_map:
-            response = format_response(response, key_map)
-        rosters = pd.DataFrame(response)
+            response = format_columns(response, key_map)
+        rosters = to_dataframe(response)
         rosters["season_id"] = self.season_id
         self.rosters = rosters
         return self.rosters
@@ -104,41 +238,307 @@ class SleeperSeason:
         :return: A DataFrame representing the winner's bracket
         """
         url = f"{self.base_url}/league/{self.season_id}/winners_bracket"
-        response = api_get_request(url)
+        response = api_get_request(
+            url,
+            client=self.client,
+            platform=self.platform,
+            ttl=self.cache_ttl,
+        )
         self.playoff_rounds_count = max([matchup["r"] for matchup in response])
         if key_map:
-            response = format_response(response, key_map)
-        winners_bracket = pd.DataFrame(response)
+            response = format_columns(response, key_map)
+        winners_bracket = to_dataframe(response)
         winners_bracket["season_id"] = self.season_id
         self.winners_bracket = winners_bracket
         return self.winners_bracket
 
-    def get_matchups(self, key_map=None):
+    def get_matchups(self, key_map=None, weeks=None):
         """
         Request the matchups for each week of this season from the
             Sleeper API
 
         :param key_map: A dictionary representing the values to be
             parsed from the API responses
+        :param weeks: The weeks to request. Defaults to every week from
+            the start of the season to the end of the playoffs.
         :return: A DataFrame representing all the matchups from this
             season
         """
+        weeks = self._weeks(weeks)
+        responses = self._get_matchups_responses(weeks)
         all_matchups = list()
-        for week in range(
-            self.start_week,
-            self.playoff_start_week + self.playoff_rounds_count,
-        ):
-            url = f"{self.base_url}/league/{self.season_id}/matchups/{week}"
-            response = api_get_request(url)
+        for week, response in zip(weeks, responses):
             if key_map:
-                response = format_response(response, key_map)
-            week_matchups = pd.DataFrame(response)
+                response = format_columns(response, key_map)
+            week_matchups = to_dataframe(response)
             week_matchups["season_id"] = self.season_id
             week_matchups["week"] = week
             all_matchups.append(pd.DataFrame(week_matchups))
         self.matchups = pd.concat(all_matchups, ignore_index=True)
         return self.matchups
 
+    def get_player_weeks(self, key_map=None, weeks=None):
+        """
+        Explode the players of every roster in the matchups of each
+            week of this season into one row per player per roster per
+            week, with the points the player scored and whether they
+            started. The weeks are requested (unless get_matchups
+            already did) and exploded a few at a time.
+
+        :param key_map: A dictionary representing the columns to keep,
+            or its plan from compile_key_map. Its keys are the columns
+            season_id, week, roster_id, matchup_id, player_id,
+            is_starter, starter_slot and points.
+        :param weeks: The weeks to request. Defaults to every week from
+            the start of the season to the end of the playoffs.
+        :return: A generator of DataFrames, one per week
+        """
+        if isinstance(key_map, dict):
+            key_map = compile_key_map(key_map)
+        weeks = list(self._weeks(weeks))
+        batch_size = max(self.concurrency, 1)
+        for start in range(0, len(weeks), batch_size):
+            batch = weeks[start : start + batch_size]
+            responses = self._get_matchups_responses(batch)
+            for week, response in zip(batch, responses):
+                with span("explode_players") as s:
+                    player_weeks = self._explode_players(
+                        response or list(), week, key_map
+                    )
+                    s.add(rows=len(player_weeks))
+                yield player_weeks
+
+    def _explode_players(self, response, week, plan=None):
+        """
+        Helper function to explode the players of the matchups of a week
+            for get_player_weeks, a column at a time, looking the starter
+            slot and points of each player up in its roster's matchup
+
+        :param response: The API response of the matchups of the week
+        :param week: The week
+        :param plan: The plan from compile_key_map of the columns to
+            keep, or None to keep every column
+        :return: A DataFrame
+        """
+        players = [matchup.get("players") or list() for matchup in response]
+        starter_slots = [
+            _starter_slots(matchup.get("starters") or list())
+            for matchup in response
+        ]
+        points = [
+            matchup.get("players_points") or dict() for matchup in response
+        ]
+        player_weeks = pd.DataFrame(
+            {
+                "roster_id": _repeat(
+                    [matchup.get("roster_id") for matchup in response],
+                    players,
+                ),
+                "matchup_id": _repeat(
+                    [matchup.get("matchup_id") for matchup in response],
+                    players,
+                ),
+                "player_id": _chain(players),
+                "starter_slot": pd.Series(
+                    [
+                        slots.get(player_id, np.nan)
+                        for slots, roster_players in zip(
+                            starter_slots, players
+                        )
+                        for player_id in roster_players
+                    ],
+                    dtype="float64",
+                ),
+                "points": pd.Series(
+                    [
+                        roster_points.get(player_id, np.nan)
+                        for roster_points, roster_players in zip(
+                            points, players
+                        )
+                        for player_id in roster_players
+                    ],
+                    dtype="float64",
+                ),
+            }
+        )
+        player_weeks["is_starter"] = player_weeks["starter_slot"].notna()
+        player_weeks["season_id"] = self.season_id
+        player_weeks["week"] = week
+        if plan is None:
+            return player_weeks
+        player_weeks = player_weeks.reindex(
+            columns=[path[0] for path, _, _ in plan]
+        )
+        player_weeks.columns = [col_name for _, col_name, _ in plan]
+        return player_weeks
+
+    def _weeks(self, weeks=None):
+        """
+        Get the weeks to request the matchups of
+
+        :param weeks: The weeks asked for, if any
+        :return: weeks, or by default every week from the start of the
+            season to the end of the playoffs
+        """
+        if weeks is not None:
+            return weeks
+        return range(
+            self.start_week,
+            self.playoff_start_week + self.playoff_rounds_count,
+        )
+
+    def _get_matchups_responses(self, weeks):
+        """
+        Request the matchups of several weeks, concurrently, keeping
+            the responses for the other table built from them until the
+            season is released
+
+        :param weeks: The weeks to request
+        :return: A list of the API responses, in the same order as weeks
+        """
+        return self._get_week_responses(
+            "matchups", weeks, self.matchups_responses
+        )
+
+    def _get_week_responses(self, endpoint, weeks, responses):
+        """
+        Request an endpoint of the season for several weeks,
+            concurrently, unless a response is already kept
+
+        :param endpoint: The name of the endpoint, e.g. matchups
+        :param weeks: The weeks to request
+        :param responses: The dictionary of weeks to responses kept for
+            the endpoint, which the new responses are added to
+        :return: A list of the API responses, in the same order as weeks
+        """
+        missing_weeks = [week for week in weeks if week not in responses]
+        urls = [
+            f"{self.base_url}/league/{self.season_id}/{endpoint}/{week}"
+            for week in missing_weeks
+        ]
+        responses.update(
+            zip(
+                missing_weeks,
+                api_get_requests(
+                    urls,
+                    concurrency=self.concurrency,
+                    client=self.client,
+                    platform=self.platform,
+                    ttl=self.cache_ttl,
+                ),
+            )
+        )
+        return [responses[week] for week in weeks]
+
+    def get_transactions(self, key_map=None, weeks=None):
+        """
+        Request the transactions (trades, waiver claims and free agent
+            moves) of each week of this season from the Sleeper API
+
+        :param key_map: A dictionary representing the values to be
+            parsed from the API responses
+        :param weeks: The weeks to request. Defaults to every week from
+            the start of the season to the end of the playoffs.
+        :return: A generator of DataFrames, one per week
+        """
+        # Only waiver claims have settings (their bid); the others have
+        # null, which would otherwise be kept as a column of its own
+        return self._transaction_frames(
+            lambda response: [
+                {**transaction, "settings": transaction.get("settings") or {}}
+                for transaction in response
+            ],
+            key_map,
+            weeks,
+        )
+
+    def get_transaction_adds(self, key_map=None, weeks=None):
+        """
+        Flatten the players added by the transactions of each week of
+            this season into one row per player per transaction
+
+        :param key_map: A dictionary representing the columns to keep.
+            Its keys are among transaction_id, type, status, player_id
+            and roster_id (the roster the player was added to).
+        :param weeks: The weeks to request. Defaults to every week from
+            the start of the season to the end of the playoffs.
+        :return: A generator of DataFrames, one per week
+        """
+        return self._transaction_frames(
+            lambda response: _transaction_players(response, "adds"),
+            key_map,
+            weeks,
+        )
+
+    def get_transaction_drops(self, key_map=None, weeks=None):
+        """
+        Flatten the players dropped by the transactions of each week of
+            this season into one row per player per transaction
+
+        :param key_map: A dictionary representing the columns to keep.
+            Its keys are among transaction_id, type, status, player_id
+            and roster_id (the roster the player was dropped from).
+        :param weeks: The weeks to request. Defaults to every week from
+            the start of the season to the end of the playoffs.
+        :return: A generator of DataFrames, one per week
+        """
+        return self._transaction_frames(
+            lambda response: _transaction_players(response, "drops"),
+            key_map,
+            weeks,
+        )
+
+    def get_transaction_draft_picks(self, key_map=None, weeks=None):
+        """
+        Flatten the draft picks traded by the transactions of each week
+            of this season into one row per pick per transaction
+
+        :param key_map: A dictionary representing the values to be
+            parsed from each pick, which also has the keys
+            transaction_id, type and status of its transaction
+        :param weeks: The weeks to request. Defaults to every week from
+            the start of the season to the end of the playoffs.
+        :return: A generator of DataFrames, one per week
+        """
+        return self._transaction_frames(
+            lambda response: [
+                {
+                    **pick,
+                    **_transaction_keys(transaction),
+                }
+                for transaction in response
+                for pick in transaction.get("draft_picks") or list()
+            ],
+            key_map,
+            weeks,
+        )
+
+    def _transaction_frames(self, records, key_map, weeks):
+        """
+        Build a table from the transactions of each week, requested
+            for every week at once the first time and kept for the other
+            tables built from them
+
+        :param records: A function turning the API response of a week
+            into the list of records of the table
+        :param key_map: A dictionary representing the values to be
+            parsed from each record
+        :param weeks: The weeks to request, or None for every week
+        :return: A generator of DataFrames, one per week
+        """
+        weeks = list(self._weeks(weeks))
+        responses = self._get_week_responses(
+            "transactions", weeks, self.transactions_responses
+        )
+        for week, response in zip(weeks, responses):
+            week_records = records(response or list())
+            if key_map:
+                week_records = format_columns(week_records, key_map)
+            transactions = to_dataframe(week_records)
+            transactions["season_id"] = self.season_id
+            transactions["week"] = week
+            yield transactions
+
     def get_users(self, key_map=None):
         """
         Request the users for this season from the Sleeper API
@@ -148,10 +548,75 @@ class SleeperSeason:
         :return: A DataFrame representing the users
         """
         url = f"{self.base_url}/league/{self.season_id}/users"
-        response = api_get_request(url)
+        response = api_get_request(
+            url,
+            client=self.client,
+            platform=self.platform,
+            ttl=self.cache_ttl,
+        )
         if key_map:
-            response = format_response(response, key_map)
-        users = pd.DataFrame(response)
+            response = format_columns(response, key_map)
+        users = to_dataframe(response)
         users["season_id"] = self.season_id
         self.users = users
         return self.users
+
+
+def _repeat(values, lists):
+    """
+    Repeat each value as many times as the items of its list
+
+    :param values: A list of values
+    :param lists: A list of sized collections, one per value
+    :return: A pandas.Series
+    """
+    counts = [len(items) for items in lists]
+    repeated = pd.Series(values, dtype=object).repeat(counts)
+    return repeated.reset_index(drop=True).infer_objects()
+
+
+def _chain(lists):
+    return list(itertools.chain.from_iterable(lists))
+
+
+def _starter_slots(starters):
+    """
+    Map each starter of a roster to its first slot in the lineup
+
+    :param starters: The list of player IDs in the starting lineup
+    :return: A dictionary of player IDs to slots
+    """
+    slots = dict()
+    for slot, player_id in enumerate(starters):
+        slots.setdefault(player_id, slot)
+    return slots
+
+
+def _transaction_keys(transaction):
+    return {
+        "transaction_id": transaction.get("transaction_id"),
+        "type": transaction.get("type"),
+        "status": transaction.get("status"),
+    }
+
+
+def _transaction_players(response, moves):
+    """
+    Flatten the players added or dropped by transactions
+
+    :param response: The API response of the transactions of a week
+    :param moves: adds or drops, the key of a transaction mapping each
+        player ID to the ID of the roster it was added to or dropped
+        from
+    :return: A list of records with the keys of _transaction_keys,
+        player_id and roster_id
+    """
+    return [
+        {
+            **_transaction_keys(transaction),
+            "player_id": player_id,
+            "roster_id": roster_id,
+        }
+        for transaction in response
+        for player_id, roster_id in (transaction.get(moves) or dict()).items()
+    ]
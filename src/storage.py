@@ -0,0 +1,462 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import fsspec
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src.metrics import span
+
+_CONVERSION_ERRORS = (
+    pa.ArrowInvalid,
+    pa.ArrowTypeError,
+    pa.ArrowNotImplementedError,
+    TypeError,
+    ValueError,
+)
+
+# The Arrow type each BigQuery data type in a key_map is written as
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "INT64": pa.int64(),
+    "INTEGER": pa.int64(),
+    "FLOAT64": pa.float64(),
+    "FLOAT": pa.float64(),
+    "BOOL": pa.bool_(),
+    "BOOLEAN": pa.bool_(),
+}
+
+
+def to_arrow_table(df, data_types):
+    """
+    Convert a DataFrame to an Arrow table typed by a key_map's data
+        types, column by column, turning empty strings into nulls.
+        The tables are converted from their DataFrame rather than from
+        the formatted columns, since every table is hashed (row_hashes)
+        and split into partitions as a DataFrame before it is written,
+        and several are built with frame operations (e.g. matchups).
+
+    :param df: The DataFrame to convert
+    :param data_types: A dictionary of column names to BigQuery data
+        types, as returned by get_data_types. Columns missing from df
+        are written as all null; columns of df missing from data_types
+        are written with their inferred type after them.
+    :return: A pyarrow.Table
+    """
+    names = list(data_types) + [col for col in df if col not in data_types]
+    arrays = list()
+    for name in names:
+        arrow_type = ARROW_TYPES.get(data_types.get(name))
+        if name not in df:
+            arrays.append(pa.nulls(len(df), type=arrow_type or pa.null()))
+            continue
+        arrays.append(_to_arrow_array(df[name], arrow_type))
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def _to_arrow_array(series, arrow_type):
+    """
+    Helper function to convert a column for to_arrow_table
+
+    :param series: A pandas.Series
+    :param arrow_type: The Arrow type to coerce the column to, or None
+        to infer it
+    :return: A pyarrow.Array
+    """
+    try:
+        array = pa.array(series, type=arrow_type, from_pandas=True)
+    except _CONVERSION_ERRORS:
+        array = _coerce_array(series, arrow_type)
+    if _is_string(array.type):
+        array = pc.if_else(
+            pc.equal(array, ""), pa.scalar(None, type=array.type), array
+        )
+        if arrow_type is not None and arrow_type != array.type:
+            array = array.cast(arrow_type)
+    return array
+
+
+def _coerce_array(series, arrow_type):
+    """
+    Helper function to convert a column whose values are not all of
+        the type it is written as, e.g. booleans for an integer column,
+        numbers sent as strings, or empty strings among numbers
+
+    :param series: A pandas.Series
+    :param arrow_type: The Arrow type to coerce the column to, or None
+    :return: A pyarrow.Array, of strings if the values could only be
+        converted as strings
+    """
+    try:
+        return pa.array(series, from_pandas=True).cast(arrow_type)
+    except _CONVERSION_ERRORS:
+        return pa.array(
+            series.astype(str).where(series.notna()), from_pandas=True
+        )
+
+
+def _is_string(arrow_type):
+    return pa.types.is_string(arrow_type) or pa.types.is_large_string(
+        arrow_type
+    )
+
+
+def write_parquet(
+    table,
+    path,
+    compression="snappy",
+    use_dictionary=True,
+    row_group_size=None,
+    write_statistics=True,
+):
+    """
+    Write an Arrow table as the only file of a parquet directory,
+        replacing anything already there
+
+    :param table: The pyarrow.Table to write
+    :param path: A local path or any fsspec URL (e.g.
+        gs://bucket/prefix) of the directory
+    :param compression: The compression codec (e.g. snappy, zstd,
+        gzip, none)
+    :param use_dictionary: Whether to dictionary encode columns; True,
+        False, or a list of column names
+    :param row_group_size: The maximum number of rows per row group.
+        Defaults to the whole table.
+    :param write_statistics: Whether to write column statistics
+    :return: The path of the written file
+    """
+    with span("parquet_write") as s:
+        remove_path(path)
+        fs, fs_path = fsspec.core.url_to_fs(path)
+        fs.makedirs(fs_path, exist_ok=True)
+        file_path = f"{fs_path}/part.0.parquet"
+        with fs.open(file_path, "wb") as f:
+            pq.write_table(
+                table,
+                f,
+                compression=compression,
+                use_dictionary=use_dictionary,
+                row_group_size=row_group_size,
+                write_statistics=write_statistics,
+            )
+            s.add(rows=table.num_rows, bytes_out=f.tell())
+    return file_path
+
+
+def compact_parquet(
+    source_files,
+    path,
+    data_types,
+    compression="zstd",
+    use_dictionary=True,
+    row_group_size=1000000,
+    max_rows_per_file=None,
+    write_statistics=True,
+):
+    """
+    Merge many small parquet files into as few files of a parquet
+        directory as max_rows_per_file allows, with full row groups,
+        replacing anything already there. The files are read one at a
+        time, so that only about a row group is held in memory.
+
+    :param source_files: A list of local paths or fsspec URLs of the
+        parquet files to merge
+    :param path: A local path or any fsspec URL of the directory
+    :param data_types: A dictionary of column names to BigQuery data
+        types. The files are written with these columns only, typed
+        as to_arrow_table types them, with nulls for the columns a
+        source file lacks.
+    :param compression: The compression codec (e.g. zstd, snappy,
+        gzip, none)
+    :param use_dictionary: Whether to dictionary encode columns; True,
+        False, or a list of column names
+    :param row_group_size: The number of rows per row group
+    :param max_rows_per_file: The number of rows after which a new
+        file is started, at the end of a row group. Defaults to a
+        single file.
+    :param write_statistics: Whether to write column statistics
+    :return: The list of the paths of the written files
+    """
+    with span("compact") as s:
+        remove_path(path)
+        fs, fs_path = fsspec.core.url_to_fs(path)
+        fs.makedirs(fs_path, exist_ok=True)
+        schema = pa.schema(
+            (name, ARROW_TYPES.get(data_type, pa.string()))
+            for name, data_type in data_types.items()
+        )
+        writer = _RollingWriter(
+            fs,
+            fs_path,
+            schema,
+            max_rows_per_file,
+            compression=compression,
+            use_dictionary=use_dictionary,
+            write_statistics=write_statistics,
+        )
+        buffered = list()
+        buffered_rows = 0
+        for source_file in source_files:
+            source_fs, source_path = fsspec.core.url_to_fs(source_file)
+            with source_fs.open(source_path, "rb") as f:
+                table = _conform(pq.read_table(f), schema)
+            buffered.append(table)
+            buffered_rows += table.num_rows
+            while buffered_rows >= row_group_size:
+                table = pa.concat_tables(buffered)
+                writer.write(table.slice(0, row_group_size))
+                buffered = [table.slice(row_group_size)]
+                buffered_rows -= row_group_size
+        if buffered_rows or not writer.file_paths:
+            writer.write(
+                pa.concat_tables(buffered)
+                if buffered
+                else schema.empty_table()
+            )
+        writer.close()
+        s.add(rows=writer.rows, bytes_out=writer.bytes_out)
+    return writer.file_paths
+
+
+class _RollingWriter:
+    def __init__(self, fs, path, schema, max_rows_per_file, **options):
+        """
+        A writer of row groups to the files part.0.parquet,
+            part.1.parquet, ... of a parquet directory for
+            compact_parquet, starting a new file once a file holds
+            max_rows_per_file rows or more
+
+        :param fs: The fsspec filesystem of the directory
+        :param path: The path of the directory within fs
+        :param schema: The pyarrow.Schema of the files
+        :param max_rows_per_file: The number of rows after which a new
+            file is started, or None for a single file
+        :param options: The keyword arguments of pq.ParquetWriter
+        """
+        self.fs = fs
+        self.path = path
+        self.schema = schema
+        self.max_rows_per_file = max_rows_per_file
+        self.options = options
+        self.file_paths = list()
+        self.rows = 0
+        self.bytes_out = 0
+        self._file = None
+        self._writer = None
+        self._file_rows = 0
+
+    def write(self, table):
+        """
+        Write a table as one row group
+
+        :param table: A pyarrow.Table with the writer's schema
+        :return: None
+        """
+        if self._writer is None:
+            file_path = f"{self.path}/part.{len(self.file_paths)}.parquet"
+            self._file = self.fs.open(file_path, "wb")
+            self._writer = pq.ParquetWriter(
+                self._file, self.schema, **self.options
+            )
+            self.file_paths.append(file_path)
+        self._writer.write_table(table, row_group_size=max(len(table), 1))
+        self._file_rows += table.num_rows
+        self.rows += table.num_rows
+        if (
+            self.max_rows_per_file
+            and self._file_rows >= self.max_rows_per_file
+        ):
+            self.close()
+
+    def close(self):
+        """
+        Finish the file being written, if any
+
+        :return: None
+        """
+        if self._writer is None:
+            return
+        self._writer.close()
+        self.bytes_out += self._file.tell()
+        self._file.close()
+        self._file = None
+        self._writer = None
+        self._file_rows = 0
+
+
+def _conform(table, schema):
+    """
+    Helper function to give a table read by compact_parquet the
+        columns and types of the compacted files
+
+    :param table: A pyarrow.Table
+    :param schema: The pyarrow.Schema of the compacted files
+    :return: A pyarrow.Table
+    """
+    arrays = list()
+    for field in schema:
+        if field.name not in table.column_names:
+            arrays.append(pa.nulls(table.num_rows, type=field.type))
+            continue
+        column = table.column(field.name)
+        if column.type != field.type:
+            column = column.cast(field.type)
+        arrays.append(column)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def find_files(uri):
+    """
+    List the files matched by a wildcard URI the way BigQuery matches
+        them, with the wildcard spanning directories
+
+    :param uri: A local path or any fsspec URL with one wildcard, e.g.
+        gs://bucket/table/league/*.parquet
+    :return: A sorted list of the URLs (or local paths) of the files
+    """
+    prefix, suffix = uri.split("*", 1)
+    fs, fs_prefix = fsspec.core.url_to_fs(prefix)
+    protocol = prefix.split("://", 1)[0] if "://" in prefix else None
+    return sorted(
+        f"{protocol}://{name}" if protocol else name
+        for name in fs.find(fs_prefix)
+        if name.endswith(suffix)
+    )
+
+
+def read_text(path):
+    """
+    Read a small text file
+
+    :param path: A local path or any fsspec URL
+    :return: The text, or None if the file does not exist
+    """
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    try:
+        with fs.open(fs_path, "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_text(path, text):
+    """
+    Write a small text file, replacing it if it exists
+
+    :param path: A local path or any fsspec URL
+    :param text: The text to write
+    :return: None
+    """
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    with fs.open(fs_path, "w") as f:
+        f.write(text)
+
+
+def storage_root(location):
+    """
+    Get the root that every table of the pipeline is stored under
+
+    :param location: A Google Cloud Storage bucket ID, or any fsspec URL
+        (e.g. gs://bucket/prefix) or local directory
+    :return: A URL or path without a trailing slash
+    """
+    if "://" in location or location.startswith((".", "/", "~")):
+        return location.rstrip("/")
+    return f"gs://{location}"
+
+
+def path_exists(path):
+    """
+    Check whether a file or directory exists
+
+    :param path: A local path or any fsspec URL
+    :return: A boolean
+    """
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    return fs.exists(fs_path)
+
+
+def read_parquet(path, columns=None):
+    """
+    Read a parquet file, or a directory of parquet files, from a local
+        path or any fsspec URL (e.g. gs://bucket/prefix)
+
+    :param path: The path of the file or directory
+    :param columns: The columns to read. Defaults to every column.
+    :return: A pyarrow.Table, or None if nothing exists at path
+    """
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    if not fs.exists(fs_path):
+        return None
+    return pq.read_table(fs_path, columns=columns, filesystem=fs)
+
+
+def remove_path(path):
+    """
+    Remove a file, or a directory and everything under it, if it exists
+
+    :param path: A local path or any fsspec URL
+    :return: None
+    """
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    if fs.exists(fs_path):
+        fs.rm(fs_path, recursive=True)
+
+
+class WriteQueue:
+    def __init__(self, max_workers=2, max_pending=4):
+        """
+        Initialize the WriteQueue class, a pool of threads converting
+            and writing tables in the background while the next tables
+            are extracted. Submitting a write blocks while max_pending
+            writes are waiting or running, so that extraction cannot
+            get ahead of the writes by more than max_pending tables in
+            memory.
+
+        :param max_workers: The number of writes running at once
+        :param max_pending: The maximum number of writes submitted but
+            not finished
+        """
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="write"
+        )
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run a write in the background, within the labels of the spans
+            open where it is submitted, once fewer than max_pending
+            writes are pending
+
+        :param fn: The function making the write
+        :param args: The positional arguments of fn
+        :param kwargs: The keyword arguments of fn
+        :return: A concurrent.futures.Future
+        """
+        with span("write_backpressure"):
+            self._slots.acquire()
+        try:
+            future = self._executor.submit(
+                contextvars.copy_context().run, fn, *args, **kwargs
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self):
+        """
+        Wait for every pending write, then stop the threads
+
+        :return: None
+        """
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
@@ -1,13 +1,18 @@
-import requests
-import json
 import sys
 import logging
 import argparse
 
+import pandas as pd
 import yaml
 
+from src.client import get_default_client
+from src.metrics import span
 
-def parse_args(args):
+# Marks a value whose key is missing from a record in format_columns
+_MISSING = object()
+
+
+def parse_args(args, argv=None):
     """
     Parses command line arguments based on a list of dictionaries
 
@@ -31,6 +36,8 @@ def parse_args(args):
             # ...another arg here
         }
     ]
+    :param argv: The list of command line args to parse. Defaults to
+        sys.argv.
     :return: dictionary of command line arg values
     """
     ap = argparse.ArgumentParser()
@@ -39,7 +46,7 @@ def parse_args(args):
             ap.add_argument(*item["definition"], **item["params"])
         else:
             ap.add_argument(item["definition"], **item["params"])
-    return vars(ap.parse_args())
+    return vars(ap.parse_args(argv))
 
 
 def parse_yaml(file_path):
@@ -87,17 +94,44 @@ def get_logger(
     return logger
 
 
-def api_get_request(url):
+def api_get_request(url, client=None, platform=None, ttl=None):
     """
     Make a GET request
 
     :param url: The URL to request
-    :return: The text attribute of the response
+    :param client: The HttpClient to make the request with. Defaults
+        to a client shared by the whole process.
+    :param platform: The platform the URL belongs to, used to pick its
+        rate limiter
+    :param ttl: The number of seconds to cache the response for, or
+        PERMANENT. Defaults to the TTL configured for the URL.
+    :return: The parsed body of the response
     """
-    response = requests.get(url)
-    response.raise_for_status()
-    response_text = json.loads(response.text)
-    return response_text
+    client = client or get_default_client()
+    return client.get_json(url, platform=platform, ttl=ttl)
+
+
+def api_get_requests(
+    urls, concurrency=1, client=None, platform=None, ttl=None
+):
+    """
+    Make several GET requests, optionally concurrently
+
+    :param urls: The URLs to request
+    :param concurrency: The maximum number of requests in flight at
+        once. A concurrency of 1 makes the requests one after another.
+    :param client: The HttpClient to make the requests with. Defaults
+        to a client shared by the whole process.
+    :param platform: The platform the URLs belong to, used to pick
+        their rate limiter
+    :param ttl: The number of seconds to cache the responses for, or
+        PERMANENT. Defaults to the TTL configured for each URL.
+    :return: A list of the parsed responses, in the same order as urls
+    """
+    client = client or get_default_client()
+    return client.get_json_many(
+        urls, platform=platform, concurrency=concurrency, ttl=ttl
+    )
 
 
 def format_response(response, key_map):
@@ -163,6 +197,197 @@ def _format_key(record, key, value, formatted_record):
         formatted_record[value.get("col_name") or key] = record.get(key)
 
 
+def compile_key_map(key_map, path=()):
+    """
+    Compiles a (potentially nested) key_map into a flat extraction
+        plan, so that the key_map is walked once rather than once per
+        record
+
+    :param key_map: A (potentially nested) dictionary used to filter
+        and flatten each record of an API response
+    :param path: The keys leading to key_map within the top-level
+        key_map (used when recursing)
+    :return: A tuple of (path, col_name, data_type) tuples, one per
+        column, in key_map order. path is the tuple of keys leading to
+        the column's value within a record.
+    """
+    plan = list()
+    for k, v in key_map.items():
+        if isinstance(v, dict) and not v.get("data_type"):
+            plan.extend(compile_key_map(v, path=path + (k,)))
+        else:
+            plan.append(
+                (path + (k,), v.get("col_name") or k, v["data_type"].upper())
+            )
+    return tuple(plan)
+
+
+def format_columns(response, key_map):
+    """
+    Formats an API response like format_response, but returns the
+        formatted values column by column, extracted in a single pass
+        over the records. format_response stays the reference for what
+        the values are; python -m benchmarks.format_throughput
+        --equivalence checks the two agree.
+
+    :param response: An API response of a single record (a dictionary)
+        or multiple records (a list of dictionaries)
+    :param key_map: A (potentially nested) dictionary used to filter
+        and flatten each record in the response, or its plan from
+        compile_key_map
+    :return: A dictionary mapping each column name to a list of values,
+        one per record. As with format_response, a column whose
+        top-level key is missing from every record is left out, and
+        records missing it get None.
+    """
+    with span("format") as s:
+        formatted_columns = _format_columns(response, key_map)
+        s.add(rows=len(response) if isinstance(response, list) else 1)
+    return formatted_columns
+
+
+def _format_columns(response, key_map):
+    """
+    Helper function to format an API response as described in
+        format_columns. Each entry of the plan gets its own list of
+        values, so that where several entries (or a value kept under
+        the key it was found at) share a column name, the entries are
+        merged record by record in plan order, the last one present
+        winning, as format_response overwrites them.
+
+    :param response: An API response of a single record (a dictionary)
+        or multiple records (a list of dictionaries)
+    :param key_map: A (potentially nested) dictionary, or its plan
+    :return: A dictionary mapping each column name to a list of values
+    """
+    plan = key_map if isinstance(key_map, tuple) else compile_key_map(key_map)
+    records = [response] if isinstance(response, dict) else response
+    records_count = len(records)
+    # (entry index, column name, values) for every list of values, in
+    # plan order, including those added for the values kept under the
+    # key they were found at
+    sources = list()
+    flat_keys = list()
+    nested_keys = dict()
+    for j, (path, col_name, _) in enumerate(plan):
+        values = [_MISSING] * records_count
+        sources.append((j, col_name, values))
+        if len(path) == 1:
+            flat_keys.append((path[0], values))
+            continue
+        first_j, children, deeper = nested_keys.setdefault(
+            path[0], (j, list(), list())
+        )
+        if len(path) == 2:
+            children.append((path[1], values))
+        else:
+            deeper.append((j, path[1:], values))
+    nested_keys = [
+        (key, first_j, children, deeper)
+        for key, (first_j, children, deeper) in nested_keys.items()
+    ]
+    fallbacks = dict()
+    for i, record in enumerate(records):
+        for key, values in flat_keys:
+            if key in record:
+                values[i] = record[key]
+        for key, first_j, children, deeper in nested_keys:
+            if key not in record:
+                continue
+            sub_record = record[key]
+            if not isinstance(sub_record, dict):
+                _format_fallback(
+                    fallbacks, first_j, key, i, sub_record, records_count
+                )
+                continue
+            for sub_key, values in children:
+                values[i] = sub_record.get(sub_key)
+            if deeper:
+                _format_nested(sub_record, deeper, i, fallbacks)
+    for (j, key), values in fallbacks.items():
+        sources.append((j, key, values))
+    sources.sort(key=lambda source: source[0])
+    columns = dict()
+    for _, col_name, values in sources:
+        if col_name not in columns:
+            columns[col_name] = values
+            continue
+        merged = columns[col_name]
+        for i, value in enumerate(values):
+            if value is not _MISSING:
+                merged[i] = value
+    formatted_columns = dict()
+    for col_name, values in columns.items():
+        if values.count(_MISSING) == records_count:
+            continue
+        if _MISSING in values:
+            values = [None if v is _MISSING else v for v in values]
+        formatted_columns[col_name] = values
+    return formatted_columns
+
+
+def _format_nested(record, nested_paths, i, fallbacks):
+    """
+    Helper function to extract the values nested more than two levels
+        deep in a single record for format_columns
+
+    :param record: A (potentially nested) dictionary within a record
+        from an API response
+    :param nested_paths: A list of (j, path, values) tuples; the index
+        of each nested column's plan entry, its path within record and
+        the list of its values
+    :param i: The index of the record
+    :param fallbacks: The dictionary of the values kept under the key
+        they were found at, which gains a value when a nested value is
+        not a dictionary
+    :return: None
+    """
+    for j, path, values in nested_paths:
+        value = record
+        for depth, key in enumerate(path):
+            if depth and not isinstance(value, dict):
+                _format_fallback(
+                    fallbacks, j, path[depth - 1], i, value, len(values)
+                )
+                break
+            value = value.get(key)
+        else:
+            values[i] = value
+
+
+def _format_fallback(fallbacks, j, key, i, value, records_count):
+    """
+    Like format_response, keep a value that was expected to be a
+        dictionary but is not under the key it was found at
+
+    :param fallbacks: A dictionary mapping a plan entry's index and the
+        key to the list of values kept under the key by that entry
+    :param j: The index of the plan entry that expected a dictionary
+    :param key: The key the value was found at
+    :param i: The index of the record
+    :param value: The value
+    :param records_count: The number of records being formatted
+    :return: None
+    """
+    if (j, key) not in fallbacks:
+        fallbacks[(j, key)] = [_MISSING] * records_count
+    fallbacks[(j, key)][i] = value
+
+
+def to_dataframe(data):
+    """
+    Build a DataFrame from a formatted API response
+
+    :param data: The columns returned by format_columns, or a list of
+        records
+    :return: A pandas.DataFrame
+    """
+    with span("dataframe") as s:
+        df = pd.DataFrame(data)
+        s.add(rows=len(df))
+    return df
+
+
 def get_data_types(key_map, data_types=None):
     if data_types is None:
         data_types = dict()